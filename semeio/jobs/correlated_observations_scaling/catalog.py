@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from ecl.util.util import BoolVector
+from res.enkf import ActiveList, RealizationStateEnum
+
+# implementation_type: name of the implementation type of the observation vector
+# steps: the report steps of the observation vector
+# node_sizes: the number of data points of the node at each step
+# index_map: for GEN_OBS, the data indexes of the last step in observation order
+CatalogEntry = namedtuple(
+    "CatalogEntry", ["implementation_type", "steps", "node_sizes", "index_map"]
+)
+
+
+class ObservationCatalog(object):
+    def __init__(self, facade):
+        """
+        The observation keys of a case, and per key the implementation type,
+        report steps, node sizes, GEN_OBS index map and whether the key has
+        data. Only the list of keys is built up front, everything else is
+        looked up the first time a key is referenced. Observation indexes and
+        active lists are kept per key and index list. A catalog is meant for
+        one run of a job, it is not updated if the observations or the
+        realizations with data change.
+        """
+        self.keys = [
+            facade.get_observation_key(nr)
+            for nr, _ in enumerate(facade.get_observations())
+        ]
+        self.key_set = set(self.keys)
+        self._facade = facade
+        self._entries = {}
+        self._has_data = {}
+        self._realizations = tuple(
+            facade.get_current_fs().realizationList(RealizationStateEnum.STATE_HAS_DATA)
+        )
+        self._obs_indexes = {}
+        self._active_lists = {}
+
+    def entry(self, key):
+        if key not in self._entries:
+            self._entries[key] = catalog_entry(self._facade.get_observations()[key])
+        return self._entries[key]
+
+    def keys_with_data(self, keys):
+        """
+        The keys that are observations with data in the realizations that
+        have data, only looking up the keys that have not been looked up
+        before.
+        """
+        unknown = [
+            key for key in keys if key in self.key_set and key not in self._has_data
+        ]
+        if unknown:
+            self._has_data.update(self._lookup_data(unknown))
+        return [key for key in keys if self._has_data.get(key, False)]
+
+    def obs_index(self, key, data_index_list):
+        """
+        The observation indexes of a list of data indexes of key. Only
+        GEN_OBS have data indexes that differ from the observation indexes.
+        """
+        index_map = self.entry(key).index_map
+        if index_map is None or data_index_list is None:
+            return data_index_list
+        cache_key = (key, tuple(data_index_list))
+        if cache_key not in self._obs_indexes:
+            self._obs_indexes[cache_key] = obs_index_array(
+                index_map, data_index_list
+            ).tolist()
+        return self._obs_indexes[cache_key]
+
+    def active_list(self, key, obs_index):
+        """
+        The active list of a list of observation indexes of key, all active if
+        obs_index is None.
+        """
+        cache_key = (key, None if obs_index is None else tuple(obs_index))
+        if cache_key not in self._active_lists:
+            self._active_lists[cache_key] = build_active_list(obs_index)
+        return self._active_lists[cache_key]
+
+    def _lookup_data(self, keys):
+        if len(self._realizations) == 0:
+            return {key: False for key in keys}
+
+        storage = self._facade.get_current_fs()
+        active_mask = BoolVector.createFromList(
+            self._facade.get_ensemble_size(), list(self._realizations)
+        )
+        observations = self._facade.get_observations()
+        return {key: observations[key].hasData(active_mask, storage) for key in keys}
+
+
+def catalog_entry(obs_vector):
+    implementation_type = obs_vector.getImplementationType().name
+    steps = tuple(obs_vector.getStepList().asList())
+    if implementation_type == "SUMMARY_OBS":
+        node_sizes = tuple(1 for _ in steps)
+    else:
+        node_sizes = tuple(len(obs_vector.getNode(step)) for step in steps)
+
+    index_map = None
+    if implementation_type == "GEN_OBS" and steps:
+        node = obs_vector.getNode(steps[-1])
+        index_map = pd.Index([node.getIndex(nr) for nr in range(len(node))])
+    return CatalogEntry(implementation_type, steps, node_sizes, index_map)
+
+
+def obs_index_array(index_map, data_index_list):
+    """
+    The positions of data_index_list in index_map, raises KeyError for a data
+    index that is not observed.
+    """
+    data_index = np.asarray(data_index_list)
+    positions = index_map.get_indexer(data_index)
+    if (positions < 0).any():
+        raise KeyError(data_index[positions < 0][0])
+    return positions
+
+
+def build_active_list(index_list):
+    """
+    An active list of the indexes in index_list, all active if None.
+    """
+    active_list = ActiveList()
+    if index_list is not None:
+        for index in np.asarray(index_list, dtype=np.intp).tolist():
+            active_list.addActiveIndex(index)
+    return active_list
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from collections import namedtuple
+
+# representatives: the first column of each group of duplicates
+# groups: the group of each column
+# counts: the number of columns in each group
+Duplicates = namedtuple("Duplicates", ["representatives", "groups", "counts"])
+
+
+def find_duplicates(matrix, tolerance=None):
+    """
+    Groups the identical columns of matrix by hashing them. With tolerance the
+    columns are first rounded to a grid of that spacing, so columns closer
+    than tolerance in every entry are merged, unless a grid boundary falls
+    between them.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if tolerance:
+        # Adding zero turns -0.0 into 0.0, which hash differently
+        matrix = np.round(matrix / tolerance) + 0.0
+    columns = np.ascontiguousarray(matrix.T)
+    keys = np.array([column.tobytes() for column in columns], dtype=object)
+    groups, _ = pd.factorize(keys)
+    _, representatives = np.unique(groups, return_index=True)
+    return Duplicates(representatives, groups, np.bincount(groups))
+
+
+def weighted_unique_columns(matrix, duplicates):
+    """
+    The representative columns of matrix, each scaled by the square root of
+    the size of its group. For exact duplicates the singular values are the
+    same as those of matrix, as M M^T is unchanged.
+    """
+    unique_matrix = matrix[:, duplicates.representatives]
+    return unique_matrix * np.sqrt(duplicates.counts)
+
+
+def duplicates_report(duplicates):
+    nr_columns = len(duplicates.groups)
+    nr_unique = len(duplicates.representatives)
+    return "Unique observations: {} of {} ({:.1%} reduction)".format(
+        nr_unique, nr_columns, 1.0 - nr_unique / float(max(nr_columns, 1))
+    )
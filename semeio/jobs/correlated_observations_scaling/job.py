@@ -1,22 +1,25 @@
 # -*- coding: utf-8 -*-
-import fnmatch
-
 import configsuite
+import numpy as np
 
 from copy import deepcopy
-from collections import namedtuple
+from collections import OrderedDict
 
 from semeio.jobs.correlated_observations_scaling import job_config
+from semeio.jobs.correlated_observations_scaling.catalog import ObservationCatalog
+from semeio.jobs.correlated_observations_scaling.overlay import ScalingOverlay
+from semeio.jobs.correlated_observations_scaling.parallel import primary_components
 from semeio.jobs.correlated_observations_scaling.scaled_matrix import DataMatrix
 from ert_data.measured import MeasuredData
+from semeio.jobs.correlated_observations_scaling.wildcards import (
+    NEGATION_PREFIX,
+    KeyMatcher,
+    is_pattern,
+)
 from semeio.jobs.correlated_observations_scaling.validator import (
     valid_configuration,
     valid_job,
 )
-from res.enkf import LocalObsdata, ActiveList
-
-from ecl.util.util import BoolVector
-from res.enkf import RealizationStateEnum
 
 
 def scaling_job(facade, user_config_dict):
@@ -26,48 +29,181 @@ def scaling_job(facade, user_config_dict):
     is passed to the main job.
     """
 
-    observation_keys = [
-        facade.get_observation_key(nr) for nr, _ in enumerate(facade.get_observations())
+    catalog = ObservationCatalog(facade)
+    config = _validated_configuration(catalog, user_config_dict)
+    _observation_scaling(facade, config, catalog)
+
+
+def scaling_jobs(facade, user_config_dicts, n_jobs=None):
+    """
+    Runs the scaling job for each of a list of user config dicts, as the groups
+    of a job config file. All groups are validated before any scaling is
+    applied. The data of the groups is loaded from storage once, see
+    _batch_scaling_factors, and the scaling factors of the groups can be
+    calculated in n_jobs processes. The scaling factors are recorded in the
+    order of the groups, so a later group overrides an earlier one, and are
+    applied to the observations at the end.
+    """
+    catalog = ObservationCatalog(facade)
+    configs = [
+        _validated_configuration(catalog, user_config_dict)
+        for user_config_dict in user_config_dicts
     ]
-    obs_with_data = keys_with_data(
-        facade.get_observations(),
-        observation_keys,
-        facade.get_ensemble_size(),
-        facade.get_current_fs(),
-    )
-    config_dict = _find_and_expand_wildcards(observation_keys, user_config_dict)
+
+    scale_factors = _batch_scaling_factors(facade, configs, n_jobs)
+
+    overlay = ScalingOverlay(facade.get_observations(), catalog)
+    for config, scale_factor in zip(configs, scale_factors):
+        _update_scaling(
+            facade.get_observations(), scale_factor, config.UPDATE_KEYS.keys, overlay
+        )
+    overlay.commit()
+
+
+def _validated_configuration(catalog, user_config_dict):
+    """
+    Expands wildcards, inserts default values and validates a user config dict,
+    returns the snapshot of the configuration. Only the CALCULATE_KEYS are
+    checked for data.
+    """
+    config_dict = _find_and_expand_wildcards(catalog.keys, user_config_dict)
 
     config = setup_configuration(config_dict, job_config.build_schema())
 
     if not valid_configuration(config):
         raise ValueError("Invalid configuration")
-    if not valid_job(config, observation_keys, obs_with_data):
+    obs_with_data = catalog.keys_with_data(
+        [event.key for event in config.snapshot.CALCULATE_KEYS.keys]
+    )
+    if not valid_job(config, catalog.key_set, obs_with_data):
         raise ValueError("Invalid job")
-    _observation_scaling(facade, config.snapshot)
+    return config.snapshot
 
 
-def _observation_scaling(facade, config):
+def _observation_scaling(facade, config, catalog=None):
     """
     Collects data, performs scaling and applies scaling, assumes validated input.
     """
     calculate_keys = [event.key for event in config.CALCULATE_KEYS.keys]
     index_lists = [event.index for event in config.CALCULATE_KEYS.keys]
     measured_data = MeasuredData(facade, calculate_keys, index_lists)
-    measured_data.remove_failed_realizations()
-    measured_data.remove_inactive_observations()
-    measured_data.filter_ensemble_mean_obs(config.CALCULATE_KEYS.alpha)
-    measured_data.filter_ensemble_std(config.CALCULATE_KEYS.std_cutoff)
+    _filter_measured_data(
+        measured_data, config.CALCULATE_KEYS.alpha, config.CALCULATE_KEYS.std_cutoff
+    )
 
     matrix = DataMatrix(measured_data.data)
     matrix.std_normalization(inplace=True)
 
-    scale_factor = matrix.get_scaling_factor(config.CALCULATE_KEYS)
+    scale_factor, report = matrix.get_scaling_factor_report(config.CALCULATE_KEYS)
+    print(report)
+
+    overlay = ScalingOverlay(facade.get_observations(), catalog)
+    _update_scaling(
+        facade.get_observations(), scale_factor, config.UPDATE_KEYS.keys, overlay
+    )
+    overlay.commit()
+
+
+def _filter_measured_data(measured_data, alpha, std_cutoff):
+    measured_data.remove_failed_realizations()
+    measured_data.remove_inactive_observations()
+    measured_data.filter_ensemble_mean_obs(alpha)
+    measured_data.filter_ensemble_std(std_cutoff)
+
+
+def _batch_scaling_factors(facade, configs, n_jobs=None):
+    """
+    The scaling factor of the CALCULATE_KEYS of each config. The union of the
+    keys of all configs with the same alpha and std_cutoff is loaded and
+    filtered once. The filters act on each observation separately, so the
+    factor of each config is calculated from its columns of the shared data,
+    in n_jobs processes if given.
+    """
+    batches = OrderedDict()
+    for nr, config in enumerate(configs):
+        settings = (config.CALCULATE_KEYS.alpha, config.CALCULATE_KEYS.std_cutoff)
+        batches.setdefault(settings, []).append(nr)
+
+    scale_factors = [None] * len(configs)
+    for (alpha, std_cutoff), members in batches.items():
+        events = [event for nr in members for event in configs[nr].CALCULATE_KEYS.keys]
+        loaded_index_lists = _shared_index_lists(events)
+        measured_data = MeasuredData(
+            facade, list(loaded_index_lists), list(loaded_index_lists.values())
+        )
+        print(
+            "Loaded {} observation keys for {} groups".format(
+                len(loaded_index_lists), len(members)
+            )
+        )
+
+        # Index lists are positions among the columns of a key before filtering
+        group_columns = [
+            _event_columns(
+                measured_data.data.columns,
+                configs[nr].CALCULATE_KEYS.keys,
+                loaded_index_lists,
+            )
+            for nr in members
+        ]
+
+        _filter_measured_data(measured_data, alpha, std_cutoff)
+        matrix = DataMatrix(measured_data.data)
+        matrix.std_normalization(inplace=True)
+
+        column_masks = [matrix.data.columns.isin(columns) for columns in group_columns]
+        if not all(mask.any() for mask in column_masks):
+            raise ValueError("Empty dataset, all data has been filtered out")
+        components = primary_components(
+            matrix.get_data_matrix(),
+            [np.flatnonzero(mask) for mask in column_masks],
+            [configs[nr].CALCULATE_KEYS.threshold for nr in members],
+            n_jobs,
+        )
+
+        for nr, mask, (nr_components, report) in zip(members, column_masks, components):
+            print(report)
+            scale_factors[nr] = DataMatrix._calculate_scaling_factor(
+                int(mask.sum()), nr_components
+            )
+            print(
+                "Scaling factor calculated from {}".format(
+                    configs[nr].CALCULATE_KEYS.keys
+                )
+            )
+    return scale_factors
 
-    update_data = _create_active_lists(
-        facade.get_observations(), config.UPDATE_KEYS.keys
+
+def _shared_index_lists(events):
+    """
+    The index list to load for each key of events. A key is loaded with the
+    index list of its events if they all have the same one, otherwise all of
+    the key is loaded.
+    """
+    event_index_lists = OrderedDict()
+    for event in events:
+        index = None if event.index is None else list(event.index)
+        key_index_lists = event_index_lists.setdefault(event.key, [])
+        if index not in key_index_lists:
+            key_index_lists.append(index)
+    return OrderedDict(
+        (key, index_lists[0] if len(index_lists) == 1 else None)
+        for key, index_lists in event_index_lists.items()
     )
 
-    _update_scaling(facade.get_observations(), scale_factor, update_data)
+
+def _event_columns(columns, events, loaded_index_lists):
+    """
+    The columns of the loaded data that belong to events.
+    """
+    keys = columns.get_level_values(0)
+    event_columns = []
+    for event in events:
+        key_columns = columns[keys == event.key]
+        if event.index is not None and loaded_index_lists[event.key] is None:
+            key_columns = key_columns[list(event.index)]
+        event_columns.extend(key_columns)
+    return event_columns
 
 
 def _wildcard_to_dict_list(matching_keys, entry):
@@ -82,29 +218,40 @@ def _wildcard_to_dict_list(matching_keys, entry):
         return [{"key": key} for key in matching_keys]
 
 
-def _expand_wildcard(obs_list, wildcard_key, entry):
-    """
-    Expands a wildcard
-    """
-    matching_keys = fnmatch.filter(obs_list, wildcard_key["key"])
-    return _wildcard_to_dict_list(matching_keys, entry)
-
-
 def _find_and_expand_wildcards(obs_list, user_dict):
     """
     Loops through the user input and identifies wildcards in observation
-    names and expands them.
+    names and expands them. All wildcards of the user input are matched
+    in one pass over obs_list. A key starting with "!" removes the keys it
+    matches from the keys listed before it, and a key starting with "re:"
+    is a regular expression.
     """
-    new_dict = deepcopy(user_dict)
-    for main_key, value in user_dict.items():
+    main_keys = [key for key in ("UPDATE_KEYS", "CALCULATE_KEYS") if key in user_dict]
+    patterns = OrderedDict()
+    for main_key in main_keys:
+        for val in user_dict[main_key]["keys"]:
+            if is_pattern(val["key"]):
+                pattern = val["key"]
+                if pattern.startswith(NEGATION_PREFIX):
+                    pattern = pattern[len(NEGATION_PREFIX) :]
+                patterns[pattern] = None
+    patterns = list(patterns)
+    matches = dict(zip(patterns, KeyMatcher(patterns).matches(obs_list)))
+
+    new_dict = dict(user_dict)
+    for main_key in main_keys:
         new_entries = []
-        if main_key in ("UPDATE_KEYS", "CALCULATE_KEYS"):
-            for val in value["keys"]:
-                if "*" in val["key"]:
-                    new_entries.extend(_expand_wildcard(obs_list, val, val["key"]))
-                else:
-                    new_entries.append(val)
-            new_dict[main_key]["keys"] = new_entries
+        for val in user_dict[main_key]["keys"]:
+            if val["key"].startswith(NEGATION_PREFIX):
+                excluded = set(matches[val["key"][len(NEGATION_PREFIX) :]])
+                new_entries = [
+                    entry for entry in new_entries if entry["key"] not in excluded
+                ]
+            elif is_pattern(val["key"]):
+                new_entries.extend(_wildcard_to_dict_list(matches[val["key"]], val))
+            else:
+                new_entries.append(deepcopy(val))
+        new_dict[main_key] = dict(user_dict[main_key], keys=new_entries)
 
     return new_dict
 
@@ -118,115 +265,22 @@ def setup_configuration(input_data, schema):
     return config
 
 
-def _create_active_lists(enkf_observations, events):
-    """
-    Will add observation vectors to observation data. Returns
-    a list of tuples mirroring the user config but also containing
-    the active list where the scaling factor will be applied.
-    """
-    new_events = []
-    observation_data = LocalObsdata("some_name", enkf_observations)
-    for event in events:
-        observation_data.addObsVector(enkf_observations[event.key])
-
-        obs_index = _data_index_to_obs_index(enkf_observations, event.key, event.index)
-        new_active_list = _get_active_list(observation_data, event.key, obs_index)
-
-        new_events.append(_make_tuple(event.key, event.index, new_active_list))
-
-    return new_events
-
-
-def _get_active_list(observation_data, key, index_list):
-    """
-    If the user doesn't supply an index list, the existing active
-    list from the observation is used, otherwise an active list is
-    created from the index list.
-    """
-    if index_list is not None:
-        return _active_list_from_index_list(index_list)
-    else:
-        return observation_data.copy_active_list(key).setParent()
-
-
-def _make_tuple(
-    key,
-    index,
-    active_list,
-    new_event=namedtuple("named_dict", ["key", "index", "active_list"]),
-):
-    return new_event(key, index, active_list)
-
-
-def _update_scaling(obs, scale_factor, events):
+def _update_scaling(obs, scale_factor, events, overlay=None):
     """
     Applies the scaling factor to the user specified index, SUMMARY_OBS needs to be treated differently
     as it only has one data point per node, compared with other observation types which have multiple
-    data points per node.
+    data points per node. If an overlay is given the scaling factor is only recorded in it, and is
+    applied when the overlay is committed.
     """
+    commit = overlay is None
+    if overlay is None:
+        overlay = ScalingOverlay(obs)
     for event in events:
-        obs_vector = obs[event.key]
-        for index, obs_node in enumerate(obs_vector):
-            if obs_vector.getImplementationType().name == "SUMMARY_OBS":
-                index_list = (
-                    event.index if event.index is not None else range(len(obs_vector))
-                )
-                if index in index_list:
-                    obs_node.set_std_scaling(scale_factor)
-            elif obs_vector.getImplementationType().name != "SUMMARY_OBS":
-                obs_node.updateStdScaling(scale_factor, event.active_list)
+        overlay.add(event.key, event.index, scale_factor)
+    if commit:
+        overlay.commit()
     print(
         "Keys: {} scaled with scaling factor: {}".format(
             [event.key for event in events], scale_factor
         )
     )
-
-
-def _active_list_from_index_list(index_list):
-    """
-    Creates an ActiveList from a list of indexes
-    :param index_list: list of index
-    :type index_list:  list
-    :return: Active list, a c-object with mode (ALL-ACTIVE, PARTIALLY-ACTIVE, INACTIVE) and list of indices
-    :rtype: active_list
-    """
-    active_list = ActiveList()
-    [active_list.addActiveIndex(index) for index in index_list]
-    return active_list
-
-
-def _set_active_lists(observation_data, key_list, active_lists):
-    """
-    Will make a backup of the existing active list on the observation node
-    before setting the user supplied index list.
-    """
-    exisiting_active_lists = []
-    for key, active_list in zip(key_list, active_lists):
-        exisiting_active_lists.append(observation_data.copy_active_list(key))
-        observation_data.setActiveList(key, active_list)
-    return observation_data, exisiting_active_lists
-
-
-def keys_with_data(observations, keys, ensamble_size, storage):
-    """
-    Checks that all keys have data and returns a list of error messages
-    """
-    active_realizations = storage.realizationList(RealizationStateEnum.STATE_HAS_DATA)
-
-    if len(active_realizations) == 0:
-        return []
-
-    active_mask = BoolVector.createFromList(ensamble_size, active_realizations)
-    return [key for key in keys if observations[key].hasData(active_mask, storage)]
-
-
-def _data_index_to_obs_index(obs, obs_key, data_index_list):
-    if obs[obs_key].getImplementationType().name != "GEN_OBS":
-        return data_index_list
-    elif data_index_list is None:
-        return data_index_list
-
-    for timestep in obs[obs_key].getStepList().asList():
-        node = obs[obs_key].getNode(timestep)
-        index_map = {node.getIndex(nr): nr for nr in range(len(node))}
-    return [index_map[index] for index in data_index_list]
\ No newline at end of file
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+import numpy as np
+
+from semeio.jobs.correlated_observations_scaling.catalog import (
+    build_active_list,
+    catalog_entry,
+    obs_index_array,
+)
+
+
+class ScalingOverlay(object):
+    def __init__(self, observations, catalog=None):
+        """
+        Std scaling factors per observation key, node and index, recorded for
+        the groups of a run and applied to the observation nodes at once by
+        commit. A factor recorded later for the same index replaces the
+        earlier one, as when the factors are applied directly. The
+        implementation type, node sizes and observation indexes are taken from
+        catalog if given.
+        """
+        self.observations = observations
+        self.catalog = catalog
+        self._entries = {}
+        self._factors = OrderedDict()
+
+    def add(self, key, index_list, scale_factor):
+        """
+        Records scale_factor for the data indexes in index_list of key, all of
+        the key if index_list is None. For SUMMARY_OBS the indexes are the
+        nodes of the observation vector, otherwise the indexes are the same for
+        every node of the vector.
+        """
+        entry = self._entry(key)
+        factors = self._factors.get(key)
+        if factors is None:
+            factors = np.full((len(entry.steps), max(entry.node_sizes + (0,))), np.nan)
+            self._factors[key] = factors
+
+        if entry.implementation_type == "SUMMARY_OBS":
+            factors[_selected(index_list, len(entry.steps)), 0] = scale_factor
+        else:
+            index_list = self._obs_index(key, index_list)
+            factors[:, _selected(index_list, factors.shape[1])] = scale_factor
+
+    def commit(self):
+        """
+        Applies the recorded factors, with one call per node and distinct
+        factor, and clears the overlay.
+        """
+        for key, factors in self._factors.items():
+            entry = self._entry(key)
+            obs_vector = self.observations[key]
+            for step, size, node_factors in zip(entry.steps, entry.node_sizes, factors):
+                node_factors = node_factors[:size]
+                scaled = ~np.isnan(node_factors)
+                if not scaled.any():
+                    continue
+                obs_node = obs_vector.getNode(step)
+                if entry.implementation_type == "SUMMARY_OBS":
+                    obs_node.set_std_scaling(float(node_factors[0]))
+                    continue
+                for scale_factor in np.unique(node_factors[scaled]):
+                    indexes = np.flatnonzero(node_factors == scale_factor)
+                    if len(indexes) == size:
+                        indexes = None
+                    obs_node.updateStdScaling(
+                        float(scale_factor), self._active_list(key, indexes)
+                    )
+        self._factors = OrderedDict()
+
+    def _entry(self, key):
+        if self.catalog is not None:
+            return self.catalog.entry(key)
+        if key not in self._entries:
+            self._entries[key] = catalog_entry(self.observations[key])
+        return self._entries[key]
+
+    def _obs_index(self, key, index_list):
+        if self.catalog is not None:
+            return self.catalog.obs_index(key, index_list)
+        index_map = self._entry(key).index_map
+        if index_map is None or index_list is None:
+            return index_list
+        return obs_index_array(index_map, index_list)
+
+    def _active_list(self, key, indexes):
+        if self.catalog is not None:
+            return self.catalog.active_list(key, indexes)
+        return build_active_list(indexes)
+
+
+def _selected(index_list, size):
+    """
+    The positions of index_list that are smaller than size, all if None.
+    """
+    if index_list is None:
+        return slice(None)
+    index_array = np.asarray(index_list, dtype=np.intp)
+    return index_array[index_array < size]
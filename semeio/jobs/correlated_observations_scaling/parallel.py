@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import sys
+
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from semeio.jobs.correlated_observations_scaling.deduplication import (
+    duplicates_report,
+    find_duplicates,
+    weighted_unique_columns,
+)
+from semeio.jobs.correlated_observations_scaling.scaled_matrix import DataMatrix
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+if sys.version_info >= (3, 5):
+    from threadpoolctl import threadpool_limits
+else:
+    # threadpoolctl requires Python 3.5, the workers are not limited
+    threadpool_limits = None
+
+# Data matrix shared with the workers, set by _init_worker
+_shared_matrix = None
+_shared_block = None
+
+
+def primary_components(matrix, groups, thresholds, n_jobs=None):
+    """
+    The number of primary components and the duplicates report of the
+    columns of matrix in each group, a list of column indexes, at the
+    threshold of the group. With n_jobs > 1 the groups are computed in that
+    many worker processes, from one copy of matrix in shared memory. The
+    workers use one BLAS thread each, so the processes do not compete for
+    the cores. The results are in the order of groups.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    tasks = [
+        (np.asarray(group), threshold) for group, threshold in zip(groups, thresholds)
+    ]
+    n_jobs = min(n_jobs or 1, len(tasks))
+    if n_jobs <= 1:
+        return [_components(matrix, *task) for task in tasks]
+
+    block, shared = _share(matrix)
+    try:
+        pool = multiprocessing.Pool(
+            n_jobs, initializer=_init_worker, initargs=(shared, matrix.shape)
+        )
+        try:
+            return pool.map(_group_components, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if shared_memory is not None:
+            block.close()
+            block.unlink()
+
+
+def _share(matrix):
+    """
+    Copies matrix to shared memory, returns the shared block and what the
+    workers need to attach to it.
+    """
+    if shared_memory is not None:
+        block = shared_memory.SharedMemory(create=True, size=max(matrix.size * 8, 1))
+        np.ndarray(matrix.shape, dtype=np.float64, buffer=block.buf)[:] = matrix
+        return block, block.name
+    block = RawArray("d", matrix.size)
+    np.frombuffer(block, dtype=np.float64).reshape(matrix.shape)[:] = matrix
+    return block, block
+
+
+def _init_worker(shared, shape):
+    global _shared_matrix, _shared_block
+    # The BLAS is already loaded in a forked worker, so it is limited at
+    # runtime, environment variables would have no effect
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+    if shared_memory is not None:
+        _shared_block = shared_memory.SharedMemory(name=shared)
+        _shared_matrix = np.ndarray(shape, dtype=np.float64, buffer=_shared_block.buf)
+    else:
+        _shared_matrix = np.frombuffer(shared, dtype=np.float64).reshape(shape)
+
+
+def _group_components(task):
+    return _components(_shared_matrix, *task)
+
+
+def _components(matrix, columns, threshold):
+    group_matrix = matrix[:, columns]
+    duplicates = find_duplicates(group_matrix)
+    nr_components = DataMatrix._get_nr_primary_components(
+        weighted_unique_columns(group_matrix, duplicates), threshold
+    )
+    return nr_components, duplicates_report(duplicates)
@@ -2,6 +2,12 @@ import numpy as np
 
 from copy import deepcopy
 
+from semeio.jobs.correlated_observations_scaling.deduplication import (
+    duplicates_report,
+    find_duplicates,
+    weighted_unique_columns,
+)
+
 
 class DataMatrix(object):
     def __init__(self, input_data):
@@ -42,18 +48,28 @@ class DataMatrix(object):
         """
         Performs PCA, calculates the number of primary components based on
         a threshold and returns a scaling factor based on the number of
-        primary components and the number of observations.
+        primary components and the number of observations. Duplicated
+        observations are collapsed before the PCA, without changing the
+        singular values.
+        """
+        return self.get_scaling_factor_report(events)[0]
+
+    def get_scaling_factor_report(self, events):
+        """
+        The scaling factor, as get_scaling_factor, and the report of the
+        duplicated observations collapsed before the PCA.
         """
         data_matrix = self.get_data_matrix()
+        duplicates = find_duplicates(data_matrix)
         nr_components = self._get_nr_primary_components(
-            data_matrix, threshold=events.threshold
+            weighted_unique_columns(data_matrix, duplicates), threshold=events.threshold
         )
         scaling_factor = self._calculate_scaling_factor(
             data_matrix.shape[1], nr_components
         )
 
         print("Scaling factor calculated from {}".format(events.keys))
-        return scaling_factor
+        return scaling_factor, duplicates_report(duplicates)
 
     def _get_data(self):
         return self.data[~self.data.index.isin(["OBS", "STD"])]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import re
+
+NEGATION_PREFIX = "!"
+REGEX_PREFIX = "re:"
+
+
+def is_pattern(key):
+    """
+    True if key is to be matched against the observation keys, not used as is.
+    """
+    return "*" in key or key.startswith(NEGATION_PREFIX) or key.startswith(REGEX_PREFIX)
+
+
+class KeyMatcher(object):
+    def __init__(self, patterns):
+        """
+        Matches keys against a list of patterns. A pattern is a shell style
+        wildcard, as for fnmatch, or a regular expression that must match all
+        of the key if prefixed by "re:". The patterns are compiled into one
+        regular expression, and only the keys that match it are tested against
+        the patterns with the same literal prefix as the key.
+        """
+        self.patterns = list(patterns)
+        expressions = [_expression(pattern) for pattern in self.patterns]
+        self._compiled = [re.compile(expression) for expression in expressions]
+        self._combined = re.compile(
+            "|".join("(?:{})".format(expression) for expression in expressions)
+        )
+        self._by_prefix = {}
+        for nr, pattern in enumerate(self.patterns):
+            self._by_prefix.setdefault(_literal_prefix(pattern), []).append(nr)
+        self._prefix_lengths = sorted(set(len(prefix) for prefix in self._by_prefix))
+
+    def matches(self, keys):
+        """
+        The keys matching each pattern, in the order of keys, from one pass
+        over keys.
+        """
+        matches = [[] for _ in self.patterns]
+        if not self.patterns:
+            return matches
+
+        for key in keys:
+            if self._combined.match(key) is None:
+                continue
+            for length in self._prefix_lengths:
+                if length > len(key):
+                    break
+                for nr in self._by_prefix.get(key[:length], ()):
+                    if self._compiled[nr].match(key):
+                        matches[nr].append(key)
+        return matches
+
+
+def _expression(pattern):
+    if pattern.startswith(REGEX_PREFIX):
+        return r"(?:{})\Z".format(pattern[len(REGEX_PREFIX) :])
+    return fnmatch.translate(pattern)
+
+
+def _literal_prefix(pattern):
+    """
+    The part of a wildcard before the first special character, all keys
+    matching the wildcard start with it.
+    """
+    if pattern.startswith(REGEX_PREFIX):
+        return ""
+    return re.split(r"[*?\[]", pattern, maxsplit=1)[0]
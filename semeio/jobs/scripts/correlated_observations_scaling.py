@@ -1,19 +1,20 @@
+import argparse
 import collections
 
 import yaml
 from ert_shared.libres_facade import LibresFacade
 from res.enkf import ErtScript
 
-from semeio.jobs.correlated_observations_scaling.job import scaling_job
+from semeio.jobs.correlated_observations_scaling.job import scaling_jobs
 
 
 class CorrelatedObservationsScalingJob(ErtScript):
-    def run(self, job_config_file):
+    def run(self, *args):
         facade = LibresFacade(self.ert())
-        user_config = load_yaml(job_config_file)
+        args = correlated_observations_scaling_parser().parse_args(args)
+        user_config = load_yaml(args.job_config_file)
         user_config = _insert_default_group(user_config)
-        for job_config in user_config:
-            scaling_job(facade, job_config)
+        scaling_jobs(facade, user_config, n_jobs=args.jobs)
 
 
 def load_yaml(f_name):
@@ -26,3 +27,23 @@ def _insert_default_group(value):
     if isinstance(value, collections.Mapping):
         return [value]
     return value
+
+
+def correlated_observations_scaling_parser():
+    parser = argparse.ArgumentParser(
+        description="Scales the observation errors of correlated observations"
+    )
+    parser.add_argument(
+        "job_config_file", type=str, help="yaml file with the groups to scale"
+    )
+    parser.add_argument(
+        "--jobs",
+        required=False,
+        type=int,
+        help="""
+        Number of processes calculating the scaling factors of the groups.
+        The factors are applied to the observations in the order of the
+        groups.
+        """,
+    )
+    return parser
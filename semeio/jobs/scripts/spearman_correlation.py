@@ -1,9 +1,22 @@
 import argparse
 
+import numpy as np
+import yaml
+
 from ert_shared.libres_facade import LibresFacade
 from res.enkf import ErtScript
 
-from semeio.jobs.spearman_correlation_job.job import spearman_job
+from semeio.jobs.spearman_correlation_job.cache import (
+    SpearmanCache,
+    default_cache_directory,
+)
+from semeio.jobs.spearman_correlation_job.job import (
+    CLUSTERING_METHODS,
+    DISTANCES,
+    LINKAGE_METHODS,
+    spearman_job,
+)
+from semeio.jobs.spearman_correlation_job.partition import PARTITION_METHODS
 
 
 class SpearmanCorrelationJob(ErtScript):
@@ -13,7 +26,61 @@ class SpearmanCorrelationJob(ErtScript):
         parser = spearman_job_parser()
         args = parser.parse_args(args)
 
-        spearman_job(facade, args.threshold, args.dry_run)
+        cache_dir = args.cache_dir or default_cache_directory(facade)
+        if args.invalidate_cache:
+            SpearmanCache(cache_dir).invalidate()
+        cache = None
+        if args.cache_size > 0:
+            cache = SpearmanCache(cache_dir, max_size=args.cache_size * 2 ** 20)
+
+        spearman_job(
+            facade,
+            args.threshold,
+            args.dry_run,
+            memory_budget=args.memory_budget * 2 ** 20,
+            distance=args.distance,
+            clustering=args.clustering,
+            min_correlation=args.min_correlation,
+            approximate_recall=args.approximate_recall,
+            sweep=args.sweep,
+            auto_threshold_clusters=args.auto_threshold_clusters,
+            auto_threshold_max_size=args.auto_threshold_max_size,
+            cache=cache,
+            output_file=args.output_file,
+            partition=args.partition,
+            partition_map=args.partition_map,
+            subsample=args.subsample,
+            stratified_subsample=args.stratified_subsample,
+            seed=args.seed,
+            bootstrap=args.bootstrap,
+            consensus_level=args.consensus_level,
+            consensus_file=args.consensus_file,
+            watch=args.watch,
+            watch_timeout=args.watch_timeout,
+            deduplicate=args.deduplicate,
+            duplicate_tolerance=args.duplicate_tolerance,
+            max_cluster_size=args.max_cluster_size,
+            linkage_method=args.linkage,
+            top_partners=args.top_partners,
+            top_partners_file=args.top_partners_file,
+            jobs=args.jobs,
+        )
+
+
+def _load_partition_map(f_name):
+    with open(f_name, "r") as fin:
+        return yaml.safe_load(fin)
+
+
+def _threshold_list(value):
+    """
+    Either a comma separated list of thresholds, or start:stop:step where stop
+    is included.
+    """
+    if ":" in value:
+        start, stop, step = [float(elem) for elem in value.split(":")]
+        return [float(elem) for elem in np.arange(start, stop + step / 2.0, step)]
+    return [float(elem) for elem in value.split(",")]
 
 
 def spearman_job_parser():
@@ -25,19 +92,309 @@ def spearman_job_parser():
     parser.add_argument(
         "-t", "--threshold",
         required=False,
-        default=1.15,
+        default=None,
         type=float,
         help="""
         Forms flat clusters so that the original
         observations in each flat cluster have no greater a
-        cophenetic distance than `t`.
+        cophenetic distance than `t`. Defaults to 1.15 for the legacy
+        distance, and is required for the absolute and signed distances,
+        where the cophenetic distance is at most 1 (2 if signed).
+        """,
+    )
+    parser.add_argument(
+        "--distance",
+        required=False,
+        default="legacy",
+        choices=DISTANCES,
+        help="""
+        Distance between observations used for the clustering. "legacy" clusters
+        the rows of the correlation matrix as feature vectors and applies the
+        threshold to the inconsistency coefficient. "absolute" (1 - |rho|) and
+        "signed" (1 - rho) cluster on the correlation distance directly, and the
+        threshold is the maximum cophenetic distance within a cluster.
+        """,
+    )
+    parser.add_argument(
+        "--clustering",
+        required=False,
+        default="hierarchical",
+        choices=CLUSTERING_METHODS,
+        help="""
+        "hierarchical" cuts the --linkage dendrogram at the threshold.
+        "graph" forms clusters of observations connected by an absolute
+        correlation of at least --min-correlation, the correlation matrix is
+        never stored, only the strongly correlated pairs.
+        """,
+    )
+    parser.add_argument(
+        "--linkage",
+        required=False,
+        default="single",
+        choices=LINKAGE_METHODS,
+        help="""
+        Linkage method of the hierarchical clustering. "average" and
+        "complete" update the condensed distance matrix in place with a
+        nearest neighbour chain, so no dense matrix is needed. Average and
+        complete linkage require hierarchical clustering without --partition
+        or --bootstrap.
+        """,
+    )
+    parser.add_argument(
+        "--min-correlation",
+        required=False,
+        type=float,
+        help="""
+        Absolute correlation cutoff used with --clustering graph, defaults to
+        0.9. Requires --clustering graph.
+        """,
+    )
+    parser.add_argument(
+        "--approximate-recall",
+        required=False,
+        type=float,
+        help="""
+        Requires --clustering graph. Instead of computing all pairs of
+        correlations, candidate pairs are found with random projections and
+        only those are computed. Pairs at the cutoff are found with
+        approximately this probability, a higher value costs more time.
+        """,
+    )
+    parser.add_argument(
+        "--top-partners",
+        required=False,
+        type=int,
+        help="""
+        Number of partners to find per observation. Instead of clustering, the
+        most correlated partners of every observation, by absolute correlation
+        unless --distance signed, are written to --top-partners-file. No
+        scaling is performed.
+        """,
+    )
+    parser.add_argument(
+        "--top-partners-file",
+        required=False,
+        default="top_partners.npz",
+        type=str,
+        help="""
+        npz file with the arrays key and data_index per observation, and the
+        partners (indexes into the observations) and correlation per
+        observation and partner.
+        """,
+    )
+    parser.add_argument(
+        "--jobs",
+        required=False,
+        type=int,
+        help="""
+        Number of processes calculating the scaling factors of the clusters.
+        The factors are applied to the observations in the order of the
+        clusters.
+        """,
+    )
+    parser.add_argument(
+        "--sweep",
+        required=False,
+        type=_threshold_list,
+        help="""
+        Thresholds to evaluate, either comma separated (0.5,1.0,1.5) or as
+        start:stop:step. The linkage is computed once and the number of
+        clusters, cluster sizes and scaling factors are reported for each
+        threshold. No scaling is performed.
         """,
     )
+    parser.add_argument(
+        "--auto-threshold-clusters",
+        required=False,
+        type=int,
+        help="""
+        Search for the smallest threshold giving at most this number of
+        clusters, overrides --threshold.
+        """,
+    )
+    parser.add_argument(
+        "--auto-threshold-max-size",
+        required=False,
+        type=int,
+        help="""
+        Search for the largest threshold where no cluster has more than this
+        number of observations, overrides --threshold.
+        """,
+    )
+    parser.add_argument(
+        "--max-cluster-size",
+        required=False,
+        type=int,
+        help="""
+        Clusters with more observations than this are split along their part
+        of the dendrogram until every part fits, which bounds the size of the
+        PCA per cluster. The number of splits is reported. With --bootstrap
+        the clusters of each resample are split instead, which bounds the
+        memory of the co-assignments, the consensus clusters can be larger.
+        Requires hierarchical clustering without --partition.
+        """,
+    )
+    parser.add_argument(
+        "--partition",
+        required=False,
+        choices=PARTITION_METHODS,
+        help="""
+        Cluster within partitions of the observations first, in parallel, and
+        then merge the clusters of all partitions in a second pass. Partitions
+        are formed per observation "key", by the key patterns in
+        --partition-map ("pattern"), or by random projections of the ranks
+        ("sketch"). Requires --distance absolute or signed.
+        """,
+    )
+    parser.add_argument(
+        "--partition-map",
+        required=False,
+        type=_load_partition_map,
+        help="""
+        Yaml file mapping partition names to lists of observation key
+        patterns, used with --partition pattern.
+        """,
+    )
+    parser.add_argument(
+        "--subsample",
+        required=False,
+        type=float,
+        help="""
+        Number (or fraction, if less than 1) of realizations used for the
+        correlation and clustering. The clustering is repeated on a second
+        independent subsample and the adjusted Rand index between the two is
+        reported. Scaling factors are calculated from all realizations.
+        """,
+    )
+    parser.add_argument(
+        "--stratified-subsample",
+        required=False,
+        help="Draw one realization from each of equally large strata",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        required=False,
+        type=int,
+        help="""
+        Number of bootstrap resamples of the realizations. Each resample is
+        clustered in a worker process, and the clusters are formed from the
+        pairs of observations that end up in the same cluster in at least
+        --consensus-level of the resamples. Every pair of observations in a
+        resample cluster is stored, m * m pairs for a cluster of m
+        observations, use --max-cluster-size to bound it. Requires --distance
+        absolute or signed.
+        """,
+    )
+    parser.add_argument(
+        "--consensus-level",
+        required=False,
+        default=0.5,
+        type=float,
+        help="Fraction of the bootstrap resamples a pair must be co-clustered in",
+    )
+    parser.add_argument(
+        "--consensus-file",
+        required=False,
+        type=str,
+        help="""
+        File (npz) where the sparse matrix of co-clustering frequencies from
+        --bootstrap is written.
+        """,
+    )
+    parser.add_argument(
+        "--seed",
+        required=False,
+        type=int,
+        help="Seed for the random subsampling, resampling and projections",
+    )
+    parser.add_argument(
+        "--deduplicate",
+        required=False,
+        help="""
+        Cluster observations with identical ranks only once, they are given
+        the cluster of their representative. Not used with --bootstrap.
+        """,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--duplicate-tolerance",
+        required=False,
+        type=float,
+        help="""
+        Use with --deduplicate, also merge observations whose standardized
+        ranks (unit norm per observation) differ by less than this in every
+        realization. Requires --distance absolute or signed.
+        """,
+    )
+    parser.add_argument(
+        "--watch",
+        required=False,
+        type=float,
+        help="""
+        Poll the storage every this many seconds while the ensemble runs, and
+        accumulate the correlation as the realizations finish, so that the
+        clustering is done soon after the last realization. The ranks are
+        approximate, each value is ranked among the first 20 realizations.
+        Requires single linkage hierarchical clustering, and is not combined
+        with partition, bootstrap, subsample, deduplicate, top partners or the
+        cache.
+        """,
+    )
+    parser.add_argument(
+        "--watch-timeout",
+        required=False,
+        type=float,
+        help="Stop waiting for realizations after this many seconds",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        required=False,
+        type=str,
+        help="""
+        Directory for the cache of ranks and linkage matrices, defaults to
+        spearman_cache in the storage of the current case.
+        """,
+    )
+    parser.add_argument(
+        "--cache-size",
+        required=False,
+        default=0,
+        type=int,
+        help="""
+        Cache the ranks and linkage matrices, using at most this many MB.
+        The least recently used entries are removed first. The cache is
+        disabled by default.
+        """,
+    )
+    parser.add_argument(
+        "--invalidate-cache",
+        required=False,
+        help="""
+        Remove all cached results before running, also when the cache is not
+        used in this run.
+        """,
+        action="store_true",
+    )
     parser.add_argument(
         "--output-file",
         required=False,
         type=str,
-        help="Name of the outputfile. The format will be yaml.",
+        help="""
+        Name of the outputfile. The clusters are written in the yaml format
+        of CORRELATED_OBSERVATIONS_SCALING, one group per cluster.
+        """,
+    )
+    parser.add_argument(
+        "--memory-budget",
+        required=False,
+        default=1024,
+        type=int,
+        help="""
+        Memory (in MB) used for the blocks of the correlation matrix. If the
+        condensed correlation matrix does not fit, it is stored in a memory
+        mapped temporary file.
+        """,
     )
     parser.add_argument(
         "-n", "--dry-run",
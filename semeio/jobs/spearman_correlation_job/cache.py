@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 2 ** 30
+
+
+def default_cache_directory(facade):
+    """
+    The cache is stored with the current case in storage.
+    """
+    return os.path.join(facade.get_current_fs().getMountPoint(), "spearman_cache")
+
+
+class SpearmanCache(object):
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        """
+        Content addressed cache of the arrays computed by the Spearman job, such
+        as ranks and linkage matrices. Entries are keyed by a fingerprint of the
+        simulated data, and each entry is a directory of .npy files. When the
+        total size exceeds max_size (bytes) the least recently used entries
+        are removed.
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def fingerprint(data):
+        """
+        Hash of the simulated data, the realizations it contains and the
+        observation keys and data indexes of the columns.
+        """
+        sha = hashlib.sha1()
+        sha.update(repr(list(data.index)).encode("utf-8"))
+        sha.update(repr(list(data.columns)).encode("utf-8"))
+        sha.update(np.ascontiguousarray(data.values, dtype=np.float64).tobytes())
+        return sha.hexdigest()
+
+    def get_or_compute(self, fingerprint, name, compute):
+        """
+        Returns the cached array if present, otherwise the array is computed
+        and stored.
+        """
+        array = self.load(fingerprint, name)
+        if array is None:
+            array = compute()
+            self.store(fingerprint, name, array)
+        return array
+
+    def load(self, fingerprint, name, mmap=False):
+        """
+        The cached array, or None. With mmap the array is memory mapped read
+        only, which suits large arrays that are only read from, such as
+        ranks. Linkage matrices are loaded into memory, as older scipy
+        versions do not accept read only arrays.
+        """
+        path = self._path(fingerprint, name)
+        if not os.path.isfile(path):
+            return None
+        os.utime(os.path.dirname(path), None)
+        print("Using cached {} from {}".format(name, path))
+        return np.load(path, mmap_mode="r" if mmap else None)
+
+    def store(self, fingerprint, name, array):
+        entry = os.path.dirname(self._path(fingerprint, name))
+        if not os.path.isdir(entry):
+            os.makedirs(entry)
+        # Written to a temporary file first so that no partial file is read
+        handle, tmp_path = tempfile.mkstemp(dir=entry, suffix=".tmp")
+        with os.fdopen(handle, "wb") as fout:
+            np.save(fout, array)
+        os.rename(tmp_path, self._path(fingerprint, name))
+        os.utime(entry, None)
+        self.evict()
+
+    def invalidate(self):
+        """
+        Removes all entries
+        """
+        entries = self._entries()
+        for entry in entries:
+            shutil.rmtree(entry, ignore_errors=True)
+        print("Removed {} cached entries from {}".format(len(entries), self.directory))
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        max_size.
+        """
+        entries = sorted(self._entries(), key=os.path.getmtime)
+        sizes = [_directory_size(entry) for entry in entries]
+        total_size = sum(sizes)
+        for entry, size in zip(entries, sizes):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = [
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+        ]
+        return [entry for entry in entries if os.path.isdir(entry)]
+
+    def _path(self, fingerprint, name):
+        return os.path.join(self.directory, fingerprint, name + ".npy")
+
+
+def _directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+    )
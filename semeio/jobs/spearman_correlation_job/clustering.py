@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from scipy.cluster.hierarchy import fcluster, inconsistent
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.csgraph import minimum_spanning_tree as sparse_spanning_tree
+
+# Smallest positive float, zero distances are stored as this in sparse graphs
+_TINY = np.nextafter(0.0, 1.0)
+
+
+def correlation_distance_rows(ranks, absolute=True):
+    """
+    Returns a function giving the correlation distance, 1 - |rho| or 1 - rho,
+    from one column of the standardized ranks to all the columns.
+    """
+    observations = np.ascontiguousarray(ranks.T)
+
+    def _distance_row(index):
+        correlation = np.clip(np.dot(observations, observations[index]), -1.0, 1.0)
+        if absolute:
+            correlation = np.abs(correlation, out=correlation)
+        return 1.0 - correlation
+
+    return _distance_row
+
+
+def condensed_distance_rows(distances, nr_points):
+    """
+    Returns a function giving the distance from one point to all points,
+    read from a condensed distance matrix.
+    """
+    points = np.arange(nr_points)
+    offsets = nr_points * points - points * (points + 1) // 2
+
+    def _distance_row(index):
+        positions = np.empty(nr_points, dtype=np.intp)
+        before = points[:index]
+        positions[:index] = offsets[before] + index - before - 1
+        positions[index] = 0
+        positions[index + 1 :] = offsets[index] + points[index + 1 :] - index - 1
+        row = np.asarray(distances[positions], dtype=np.float64)
+        row[index] = 0.0
+        return row
+
+    return _distance_row
+
+
+def graph_clusters(graph):
+    """
+    Returns the connected components of the correlation graph as cluster
+    numbers starting at 1, in the same way as fcluster.
+    """
+    _, labels = connected_components(graph, directed=False)
+    return labels + 1
+
+
+def single_linkage(nr_points, distance_row):
+    """
+    Single linkage clustering by Prim's minimum spanning tree algorithm. The
+    distances are requested one row at a time through distance_row(index),
+    so apart from the linkage matrix only O(n) memory is used. Returns a
+    linkage matrix in the format of scipy.cluster.hierarchy.linkage.
+    """
+    return linkage_from_tree(nr_points, minimum_spanning_tree(nr_points, distance_row))
+
+
+def minimum_spanning_tree(nr_points, distance_row):
+    """
+    Prim's algorithm, with the distances requested one row at a time through
+    distance_row(index). Returns the nr_points - 1 edges of the tree as rows
+    of (first point, second point, distance).
+    """
+    if nr_points < 2:
+        raise ValueError("At least two observations are needed for clustering")
+
+    # Points that are not connected by a finite distance are joined last
+    min_distance = np.full(nr_points, np.finfo(np.float64).max)
+    nearest = np.zeros(nr_points, dtype=np.intp)
+    in_tree = np.zeros(nr_points, dtype=bool)
+    edges = np.empty((nr_points - 1, 3), dtype=np.float64)
+
+    current = 0
+    for nr in range(nr_points - 1):
+        in_tree[current] = True
+        min_distance[current] = np.inf
+
+        distances = distance_row(current)
+        closer = (distances < min_distance) & ~in_tree
+        min_distance[closer] = distances[closer]
+        nearest[closer] = current
+
+        current = np.argmin(min_distance)
+        edges[nr] = nearest[current], current, min_distance[current]
+
+    return edges
+
+
+def update_minimum_spanning_tree(edges, previous_points, distance_row):
+    """
+    Minimum spanning tree after points are added and removed, from the edges
+    of the tree of the previous points. previous_points gives the position of
+    each current point among the previous points, or -1 for new points.
+    Removing points splits the previous tree into a forest. An edge between
+    two points of the largest tree of the forest is never shorter than the
+    tree path between them, so only the points outside the largest tree,
+    including the new points, need their distances to all other points.
+    Returns the edges of the new tree and the number of distance rows that
+    were computed.
+    """
+    nr_points = len(previous_points)
+    if nr_points < 2:
+        raise ValueError("At least two observations are needed for clustering")
+
+    kept = previous_points >= 0
+    current = np.full(len(edges) + 1, -1, dtype=np.intp)
+    current[previous_points[kept]] = np.flatnonzero(kept)
+    first = current[edges[:, 0].astype(np.intp)]
+    second = current[edges[:, 1].astype(np.intp)]
+    remaining = (first >= 0) & (second >= 0)
+
+    forest = coo_matrix(
+        (np.ones(remaining.sum()), (first[remaining], second[remaining])),
+        shape=(nr_points, nr_points),
+    )
+    _, components = connected_components(forest, directed=False)
+    largest = np.argmax(np.bincount(components))
+    outside = components != largest
+    recomputed = np.flatnonzero(outside)
+
+    # Tree edges within the largest tree, and the edges from each point
+    # outside it, taking edges between two such points only once
+    tree_edges = np.flatnonzero(remaining)
+    tree_edges = tree_edges[~outside[first[tree_edges]]]
+    candidates = [(first[tree_edges], second[tree_edges])]
+    distances = [edges[tree_edges, 2]]
+    points = np.arange(nr_points)
+    for index in recomputed:
+        others = ~outside | (points > index)
+        candidates.append((np.full(others.sum(), index), points[others]))
+        distances.append(distance_row(index)[others])
+
+    rows = np.concatenate([row for row, _ in candidates])
+    columns = np.concatenate([column for _, column in candidates])
+    distances = np.concatenate(distances)
+    # Points not connected by a finite distance are joined last, and zero
+    # distances must be stored explicitly in the sparse graph
+    distances = np.where(np.isnan(distances), np.finfo(np.float64).max, distances)
+    distances = np.maximum(distances, _TINY)
+
+    tree = sparse_spanning_tree(
+        csr_matrix((distances, (rows, columns)), shape=(nr_points, nr_points))
+    ).tocoo()
+    tree_distances = np.where(tree.data <= _TINY, 0.0, tree.data)
+    return np.column_stack((tree.row, tree.col, tree_distances)), len(recomputed)
+
+
+def nn_chain_merges(distances, nr_points, method="average", sizes=None):
+    """
+    Average, complete or single linkage clustering by the nearest neighbour
+    chain algorithm, on a condensed distance matrix which may be memory
+    mapped. The distances are updated in place by the Lance-Williams formula
+    as clusters merge, so they are overwritten, but apart from them only O(n)
+    memory is used and the time is O(n^2). sizes gives the initial number of
+    observations each point stands for. Returns the nr_points - 1 merges as
+    rows of (first point, second point, distance), where a cluster is named
+    by one of its points, see linkage_from_tree.
+    """
+    if method not in _LANCE_WILLIAMS:
+        raise ValueError("Unknown linkage method: {}".format(method))
+    if nr_points < 2:
+        raise ValueError("At least two observations are needed for clustering")
+
+    update = _LANCE_WILLIAMS[method]
+    points = np.arange(nr_points, dtype=np.int64)
+    offsets = nr_points * points - points * (points + 1) // 2
+
+    def _positions(index, others):
+        low = np.minimum(index, others)
+        high = np.maximum(index, others)
+        return offsets[low] + high - low - 1
+
+    sizes = np.ones(nr_points) if sizes is None else np.array(sizes, dtype=np.float64)
+    active = np.ones(nr_points, dtype=bool)
+    merges = np.empty((nr_points - 1, 3), dtype=np.float64)
+    chain = []
+    for nr in range(nr_points - 1):
+        if not chain:
+            chain.append(int(np.argmax(active)))
+        while True:
+            current = chain[-1]
+            active[current] = False
+            others = np.flatnonzero(active)
+            active[current] = True
+            row = np.asarray(distances[_positions(current, others)])
+            nearest = others[np.argmin(row)]
+            # Ties are resolved in favour of the previous point in the chain,
+            # so that the chain always ends in a pair of reciprocal neighbours
+            if len(chain) > 1:
+                previous = chain[-2]
+                if distances[_positions(current, previous)] <= row.min():
+                    break
+            chain.append(int(nearest))
+
+        second, first = chain.pop(), chain.pop()
+        merges[nr] = first, second, distances[_positions(first, second)]
+
+        # The merged cluster is named by second
+        active[first] = False
+        active[second] = False
+        others = np.flatnonzero(active)
+        active[second] = True
+        to_first = np.asarray(distances[_positions(first, others)])
+        to_second = _positions(second, others)
+        distances[to_second] = update(
+            to_first, np.asarray(distances[to_second]), sizes[first], sizes[second]
+        )
+        sizes[second] += sizes[first]
+    return merges
+
+
+def _single_update(first, second, first_size, second_size):
+    return np.minimum(first, second)
+
+
+def _complete_update(first, second, first_size, second_size):
+    return np.maximum(first, second)
+
+
+def _average_update(first, second, first_size, second_size):
+    return (first_size * first + second_size * second) / (first_size + second_size)
+
+
+# Distance from a merged cluster to the other clusters, given the distances
+# from the two clusters it was merged from and their sizes
+_LANCE_WILLIAMS = {
+    "single": _single_update,
+    "complete": _complete_update,
+    "average": _average_update,
+}
+
+
+def linkage_from_tree(nr_points, edges):
+    """
+    Sorts the edges of a minimum spanning tree and labels the merged clusters
+    the same way as scipy.cluster.hierarchy.linkage.
+    """
+    edges = edges[np.argsort(edges[:, 2], kind="mergesort")]
+    parent = np.arange(2 * nr_points - 1)
+    size = np.ones(2 * nr_points - 1, dtype=np.intp)
+    linkage_matrix = np.empty((nr_points - 1, 4), dtype=np.float64)
+
+    def _find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for nr, (first, second, distance) in enumerate(edges):
+        first, second = _find(int(first)), _find(int(second))
+        new_node = nr_points + nr
+        parent[first] = parent[second] = new_node
+        size[new_node] = size[first] + size[second]
+        linkage_matrix[nr] = (
+            min(first, second),
+            max(first, second),
+            distance,
+            size[new_node],
+        )
+    return linkage_matrix
+
+
+def split_clusters(linkage_matrix, clusters, max_cluster_size):
+    """
+    Splits the flat clusters with more than max_cluster_size observations
+    along their own part of the dendrogram. An oversized cluster is replaced
+    by the two subtrees of its top link, recursively, until every part fits.
+    Returns the new cluster numbers, starting at 1, and the number of splits.
+    """
+    nr_points = len(clusters)
+    children = linkage_matrix[:, :2].astype(np.intp)
+    sizes = np.r_[np.ones(nr_points), linkage_matrix[:, 3]].astype(np.intp)
+
+    # The cluster of every node of the dendrogram, 0 if it spans several
+    node_clusters = np.zeros(2 * nr_points - 1, dtype=np.intp)
+    node_clusters[:nr_points] = clusters
+    for nr, (left, right) in enumerate(children):
+        if node_clusters[left] == node_clusters[right]:
+            node_clusters[nr_points + nr] = node_clusters[left]
+    parents = np.full(2 * nr_points - 1, -1, dtype=np.intp)
+    parents[children] = np.arange(nr_points, 2 * nr_points - 1)[:, np.newaxis]
+    is_root = (node_clusters > 0) & (
+        (parents < 0) | (node_clusters[np.maximum(parents, 0)] == 0)
+    )
+    roots = np.flatnonzero(is_root & (sizes > max_cluster_size))
+
+    def _leaves(node):
+        leaves, stack = [], [node]
+        while stack:
+            node = stack.pop()
+            if node < nr_points:
+                leaves.append(node)
+            else:
+                stack.extend(children[node - nr_points])
+        return leaves
+
+    new_clusters = np.array(clusters, dtype=np.intp)
+    next_cluster = new_clusters.max() + 1
+    nr_splits = 0
+    for root in roots:
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if sizes[node] > max_cluster_size and node >= nr_points:
+                stack.extend(children[node - nr_points])
+                nr_splits += 1
+            else:
+                new_clusters[_leaves(node)] = next_cluster
+                next_cluster += 1
+
+    _, new_clusters = np.unique(new_clusters, return_inverse=True)
+    return new_clusters.ravel() + 1, nr_splits
+
+
+def threshold_candidates(linkage_matrix, criterion="inconsistent"):
+    """
+    The values where the flat clustering of linkage_matrix can change, i.e.
+    the merge distances or the inconsistency coefficients of the links.
+    """
+    if criterion == "distance":
+        values = linkage_matrix[:, 2]
+    else:
+        values = inconsistent(linkage_matrix)[:, 3]
+    return np.unique(np.r_[0.0, values])
+
+
+def search_threshold(
+    linkage_matrix, criterion="inconsistent", max_clusters=None, max_cluster_size=None
+):
+    """
+    Binary search over the threshold candidates. With max_clusters the smallest
+    threshold giving at most max_clusters clusters is returned, with
+    max_cluster_size the largest threshold where no cluster is larger than
+    max_cluster_size. The number of clusters decreases and the cluster sizes
+    increase with the threshold, so only O(log n) cuts are evaluated. If no
+    candidate meets the target, the closest one is returned with a warning.
+    """
+    candidates = threshold_candidates(linkage_matrix, criterion)
+
+    def _acceptable(threshold):
+        clusters = fcluster(linkage_matrix, threshold, criterion=criterion)
+        if max_clusters is not None:
+            return clusters.max() <= max_clusters
+        return np.bincount(clusters).max() <= max_cluster_size
+
+    low, high = 0, len(candidates) - 1
+    if max_clusters is not None:
+        # First acceptable candidate
+        while low < high:
+            middle = (low + high) // 2
+            if _acceptable(candidates[middle]):
+                high = middle
+            else:
+                low = middle + 1
+    else:
+        # Last acceptable candidate
+        while low < high:
+            middle = (low + high + 1) // 2
+            if _acceptable(candidates[middle]):
+                low = middle
+            else:
+                high = middle - 1
+
+    if not _acceptable(candidates[low]):
+        if max_clusters is not None:
+            target = "at most {} clusters".format(max_clusters)
+        else:
+            target = "no cluster larger than {}".format(max_cluster_size)
+        print(
+            "Warning: no threshold gives {}, using threshold {}".format(
+                target, candidates[low]
+            )
+        )
+    return candidates[low]
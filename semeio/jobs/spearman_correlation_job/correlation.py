@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+
+from scipy.sparse import csr_matrix
+
+_RANK_CHUNK_SIZE = 2048
+# Number of block sized temporaries alive per thread when filling a tile
+_BLOCK_TEMPORARIES = 3
+
+DEFAULT_MEMORY_BUDGET = 2 ** 30
+
+# Buckets up to this size are turned into candidate pairs, larger buckets are
+# checked with a block matrix product
+_SMALL_BUCKET_SIZE = 64
+_MAX_LSH_TABLES = 256
+
+
+def spearman_correlation_matrix(data, n_jobs=None):
+    """
+    Calculates the Spearman correlation between the columns of data, a dataframe
+    with realizations as index. Equivalent to data.rank().corr(method="pearson"),
+    but the correlation matrix is found from a single matrix product of the
+    standardized ranks.
+    """
+    values = np.asarray(data.values, dtype=np.float64)
+    if np.isnan(values).any():
+        # Pairwise complete observations are needed, leave that to pandas
+        return data.rank().corr(method="pearson")
+
+    ranks = standardized_ranks(values, n_jobs=n_jobs)
+    correlation = _clip_correlation(np.dot(ranks.T, ranks))
+    return pd.DataFrame(correlation, index=data.columns, columns=data.columns)
+
+
+def standardized_ranks(values, n_jobs=None):
+    """
+    Ranks each column of values, ties are given the average rank, and
+    standardizes the ranks so that each column has zero mean and unit norm.
+    The Spearman correlation between two columns is then the dot product of
+    the corresponding columns of the result. Columns with zero variance
+    are set to NaN. The columns are ranked in chunks on a pool of threads.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    output = np.empty(values.shape, dtype=np.float64)
+
+    def _rank_chunk(chunk):
+        output[:, chunk] = _standardize(_rank_columns(values[:, chunk]))
+
+    _parallel_map(_rank_chunk, _column_chunks(values.shape[1]), n_jobs)
+    return output
+
+
+def column_ranks(values, n_jobs=None):
+    """
+    Ranks each column of values, ties are given the average rank. The columns
+    are ranked in chunks on a pool of threads.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    output = np.empty(values.shape, dtype=np.float64)
+
+    def _rank_chunk(chunk):
+        output[:, chunk] = _rank_columns(values[:, chunk])
+
+    _parallel_map(_rank_chunk, _column_chunks(values.shape[1]), n_jobs)
+    return output
+
+
+def condensed_correlation(ranks, memory_budget=None, n_jobs=None):
+    """
+    Calculates the correlation between all pairs of columns of the standardized
+    ranks, and returns the upper triangle of the correlation matrix in the
+    condensed form used by scipy.spatial.distance. The matrix is computed in
+    blocks of rows on a pool of threads, the memory used by the blocks is
+    bounded by memory_budget (bytes). If the condensed matrix itself does not
+    fit in the memory budget it is stored in a memory mapped temporary file.
+    """
+
+    def _correlation_block(rows):
+        return _clip_correlation(np.dot(ranks[:, rows].T, ranks[:, rows.start :]))
+
+    return _tiled_condensed(ranks.shape[1], _correlation_block, memory_budget, n_jobs)
+
+
+def condensed_correlation_distance(
+    ranks, absolute=True, memory_budget=None, n_jobs=None
+):
+    """
+    Calculates the correlation distance, 1 - |rho| if absolute else 1 - rho,
+    between all pairs of columns of the standardized ranks in condensed form.
+    Memory handling is the same as for condensed_correlation.
+    """
+
+    def _distance_block(rows):
+        correlation = _clip_correlation(
+            np.dot(ranks[:, rows].T, ranks[:, rows.start :])
+        )
+        if absolute:
+            correlation = np.abs(correlation, out=correlation)
+        return np.subtract(1.0, correlation, out=correlation)
+
+    return _tiled_condensed(ranks.shape[1], _distance_block, memory_budget, n_jobs)
+
+
+def condensed_row_distance(ranks, weights=None, memory_budget=None, n_jobs=None):
+    """
+    Calculates the euclidean distance between the rows of the correlation matrix
+    of the standardized ranks, i.e. pdist(correlation_matrix), in condensed form.
+    With C = Z^T Z the squared distance between row i and j is
+    Z_i^T G Z_i + Z_j^T G Z_j - 2 Z_i^T G Z_j where G = Z Z^T only has the size
+    of the number of realizations, so the correlation matrix is never needed.
+    With weights, the squared differences of each column of the correlation
+    matrix are weighted, G = Z W Z^T. Memory handling is the same as for
+    condensed_correlation.
+    """
+    features = _correlation_row_features(ranks, weights)
+    squared_norms = np.einsum("ij,ij->j", features, features)
+
+    def _distance_block(rows):
+        squared_distance = np.dot(features[:, rows].T, features[:, rows.start :])
+        squared_distance *= -2.0
+        squared_distance += squared_norms[rows, np.newaxis]
+        squared_distance += squared_norms[np.newaxis, rows.start :]
+        return np.sqrt(np.maximum(squared_distance, 0.0, out=squared_distance))
+
+    return _tiled_condensed(ranks.shape[1], _distance_block, memory_budget, n_jobs)
+
+
+def correlation_graph(ranks, min_correlation, memory_budget=None, n_jobs=None):
+    """
+    Returns a sparse (CSR) graph over the columns of the standardized ranks,
+    where pairs with an absolute correlation of at least min_correlation are
+    connected by an edge, only the upper triangle is stored. The correlations
+    are computed in blocks of rows on a pool of threads, so memory scales with
+    the number of strong pairs and not with the square of the number of columns.
+    """
+    nr_points = ranks.shape[1]
+    memory_budget = memory_budget or DEFAULT_MEMORY_BUDGET
+    n_jobs = _default_n_jobs(n_jobs)
+
+    def _strong_pairs(rows):
+        correlation = np.dot(ranks[:, rows].T, ranks[:, rows.start :])
+        row, column = np.nonzero(np.abs(correlation) >= min_correlation)
+        upper = column > row
+        row, column = row[upper], column[upper]
+        return (
+            row + rows.start,
+            column + rows.start,
+            _clip_correlation(correlation[row, column]),
+        )
+
+    block_bytes = _BLOCK_TEMPORARIES * n_jobs * max(nr_points, 1) * 8
+    block_size = max(1, int(memory_budget // block_bytes))
+    pairs = _parallel_map(_strong_pairs, _column_chunks(nr_points, block_size), n_jobs)
+    return _graph_from_pairs(pairs, nr_points)
+
+
+def top_correlations(ranks, k, absolute=True, memory_budget=None, n_jobs=None):
+    """
+    The k most correlated other columns of each column of the standardized
+    ranks, by absolute correlation unless absolute is False. The correlations
+    are computed in blocks of rows on a pool of threads and only the k best
+    of each row are kept, found by partial selection, so apart from the
+    blocks the memory used is O(n k). Returns the (n, k) arrays of partner
+    indexes and correlations, each row sorted from the strongest partner.
+    """
+    nr_points = ranks.shape[1]
+    k = max(min(k, nr_points - 1), 0)
+    memory_budget = memory_budget or DEFAULT_MEMORY_BUDGET
+    n_jobs = _default_n_jobs(n_jobs)
+    partners = np.empty((nr_points, k), dtype=np.intp)
+    correlations = np.empty((nr_points, k), dtype=np.float64)
+    if k == 0:
+        return partners, correlations
+
+    def _top_block(rows):
+        correlation = _clip_correlation(np.dot(ranks[:, rows].T, ranks))
+        strength = np.abs(correlation) if absolute else correlation.copy()
+        # A column is not its own partner
+        block_rows = np.arange(rows.stop - rows.start)
+        strength[block_rows, block_rows + rows.start] = -np.inf
+        top = np.argpartition(-strength, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(strength, top, axis=1), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        partners[rows] = top
+        correlations[rows] = np.take_along_axis(correlation, top, axis=1)
+
+    block_bytes = _BLOCK_TEMPORARIES * n_jobs * max(nr_points, 1) * 8
+    block_size = max(1, int(memory_budget // block_bytes))
+    _parallel_map(_top_block, _column_chunks(nr_points, block_size), n_jobs)
+    return partners, correlations
+
+
+def approximate_correlation_graph(
+    ranks, min_correlation, recall=0.95, seed=None, n_jobs=None
+):
+    """
+    Approximation of correlation_graph using sign random projections (SimHash).
+    The standardized ranks have unit norm, so the correlation is the cosine of
+    the angle between columns, and two columns get the same sign bit from a
+    random hyperplane with probability 1 - angle / pi. Columns sharing the
+    signature of a table, or its complement for negative correlation, are
+    candidate pairs, and the correlation is computed exactly for candidates
+    only. The number of tables is chosen so that pairs at the cutoff are found
+    with probability recall. Returns the graph and the estimated recall.
+    """
+    nr_realizations, nr_points = ranks.shape
+    bits = int(np.clip(np.ceil(np.log2(max(nr_points, 2))), 8, 62))
+    nr_tables, estimated_recall = _lsh_tables(min_correlation, recall, bits)
+
+    random_state = np.random.RandomState(seed)
+    planes = [
+        random_state.standard_normal((bits, nr_realizations)) for _ in range(nr_tables)
+    ]
+    observations = np.ascontiguousarray(ranks.T)
+
+    def _table_pairs(table_planes):
+        keys = signature_keys(ranks, table_planes)
+        return _bucket_pairs(observations, keys, min_correlation)
+
+    tables = _parallel_map(_table_pairs, planes, n_jobs)
+    nr_candidates = sum(candidates for _, candidates in tables)
+    pairs = _unique_pairs([strong for strong, _ in tables], nr_points)
+
+    print(
+        "Approximate correlation graph: {} tables of {} bits, {} candidate pairs, "
+        "{} pairs with |rho| >= {}, estimated recall at the cutoff: {:.3f}".format(
+            nr_tables,
+            bits,
+            nr_candidates,
+            len(pairs[0]),
+            min_correlation,
+            estimated_recall,
+        )
+    )
+    return _graph_from_pairs([pairs], nr_points), estimated_recall
+
+
+def _lsh_tables(min_correlation, recall, bits):
+    """
+    Number of tables needed for a pair with correlation min_correlation to
+    collide in at least one table with probability recall, and the recall
+    that number of tables gives.
+    """
+    angle = np.arccos(np.clip(abs(min_correlation), 0.0, 1.0))
+    bit_probability = 1.0 - angle / np.pi
+    band_probability = bit_probability ** bits + (1.0 - bit_probability) ** bits
+    if band_probability >= 1.0:
+        nr_tables = 1
+    elif recall >= 1.0 or band_probability <= 0.0:
+        nr_tables = _MAX_LSH_TABLES
+    else:
+        nr_tables = np.ceil(np.log(1.0 - recall) / np.log(1.0 - band_probability))
+        nr_tables = int(np.clip(nr_tables, 1, _MAX_LSH_TABLES))
+    return nr_tables, 1.0 - (1.0 - band_probability) ** nr_tables
+
+
+def signature_keys(ranks, planes):
+    """
+    Packs the sign bits of the projections into an integer per column. A key
+    and its complement are mapped to the same value, so columns with strong
+    negative correlation also collide.
+    """
+    bits = planes.shape[0]
+    weights = np.left_shift(np.int64(1), np.arange(bits, dtype=np.int64))
+    keys = np.empty(ranks.shape[1], dtype=np.int64)
+    for chunk in _column_chunks(ranks.shape[1]):
+        signs = np.dot(planes, ranks[:, chunk]) > 0
+        keys[chunk] = np.dot(weights, signs)
+    complement = np.bitwise_xor(keys, (np.int64(1) << bits) - 1)
+    return np.minimum(keys, complement)
+
+
+def _bucket_pairs(observations, keys, min_correlation):
+    """
+    Finds the strongly correlated pairs among columns sharing a key. Returns
+    the pairs and the number of candidate pairs that were checked.
+    """
+    nr_points = len(keys)
+    order = np.argsort(keys, kind="mergesort")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, nr_points])
+    small = np.repeat(sizes <= _SMALL_BUCKET_SIZE, sizes)
+
+    strong = []
+    nr_candidates = 0
+    for offset in range(1, min(sizes.max(initial=1), _SMALL_BUCKET_SIZE)):
+        same = (sorted_keys[offset:] == sorted_keys[:-offset]) & small[offset:]
+        first, second = order[:-offset][same], order[offset:][same]
+        strong.append(_strong_candidates(observations, first, second, min_correlation))
+        nr_candidates += len(first)
+
+    large = sizes > _SMALL_BUCKET_SIZE
+    for start, size in zip(starts[large], sizes[large]):
+        members = order[start : start + size]
+        strong.extend(_strong_block_pairs(observations, members, min_correlation))
+        nr_candidates += size * (size - 1) // 2
+    return strong, nr_candidates
+
+
+def _strong_candidates(observations, first, second, min_correlation):
+    correlation = np.empty(len(first), dtype=np.float64)
+    for chunk in _column_chunks(len(first)):
+        correlation[chunk] = np.einsum(
+            "ij,ij->i", observations[first[chunk]], observations[second[chunk]]
+        )
+    strong = np.abs(correlation) >= min_correlation
+    return first[strong], second[strong], _clip_correlation(correlation[strong])
+
+
+def _strong_block_pairs(observations, members, min_correlation):
+    members_data = observations[members]
+    for rows in _column_chunks(len(members)):
+        correlation = np.dot(members_data[rows], members_data.T)
+        row, column = np.nonzero(np.abs(correlation) >= min_correlation)
+        upper = column > row + rows.start
+        row, column = row[upper], column[upper]
+        yield (
+            members[row + rows.start],
+            members[column],
+            _clip_correlation(correlation[row, column]),
+        )
+
+
+def _unique_pairs(tables, nr_points):
+    """
+    Orients the pairs as (low, high) and removes duplicates found in several
+    tables.
+    """
+    pairs = [pair for table in tables for pair in table]
+    if not pairs:
+        return np.empty(0, np.intp), np.empty(0, np.intp), np.empty(0)
+    first, second, correlation = (np.concatenate(part) for part in zip(*pairs))
+    low, high = np.minimum(first, second), np.maximum(first, second)
+    _, unique = np.unique(low.astype(np.int64) * nr_points + high, return_index=True)
+    return low[unique], high[unique], correlation[unique]
+
+
+def _graph_from_pairs(pairs, nr_points):
+    if pairs:
+        rows, columns, values = (np.concatenate(part) for part in zip(*pairs))
+    else:
+        rows = columns = np.empty(0, dtype=np.intp)
+        values = np.empty(0, dtype=np.float64)
+    return csr_matrix((values, (rows, columns)), shape=(nr_points, nr_points))
+
+
+def _correlation_row_features(ranks, weights=None):
+    """
+    Returns Y = G^(1/2) Z, so that the dot product between column i and j of Y
+    is the dot product between row i and j of the correlation matrix Z^T Z.
+    """
+    weighted_ranks = ranks if weights is None else ranks * weights
+    eigenvalues, eigenvectors = np.linalg.eigh(np.dot(weighted_ranks, ranks.T))
+    scale = np.sqrt(np.maximum(eigenvalues, 0.0))
+    return np.dot(scale[:, np.newaxis] * eigenvectors.T, ranks)
+
+
+def _tiled_condensed(nr_points, block_func, memory_budget=None, n_jobs=None):
+    """
+    Fills a condensed matrix for nr_points, block_func(rows) is expected to
+    return the full matrix for rows, starting at column rows.start.
+    """
+    memory_budget = memory_budget or DEFAULT_MEMORY_BUDGET
+    n_jobs = _default_n_jobs(n_jobs)
+    output = _allocate_condensed(nr_points, memory_budget)
+
+    def _fill_block(rows):
+        block = block_func(rows)
+        for nr, row in enumerate(range(rows.start, rows.stop)):
+            start = _condensed_offset(nr_points, row)
+            output[start : start + nr_points - row - 1] = block[
+                nr, row - rows.start + 1 :
+            ]
+
+    block_bytes = _BLOCK_TEMPORARIES * n_jobs * max(nr_points, 1) * 8
+    block_size = max(1, int(memory_budget // block_bytes))
+    _parallel_map(_fill_block, _column_chunks(nr_points - 1, block_size), n_jobs)
+    return output
+
+
+def _condensed_offset(nr_points, row):
+    """
+    Position of (row, row + 1) in a condensed matrix
+    """
+    return nr_points * row - row * (row + 1) // 2
+
+
+def _allocate_condensed(nr_points, memory_budget):
+    size = nr_points * (nr_points - 1) // 2
+    if size * 8 <= memory_budget:
+        return np.empty(size, dtype=np.float64)
+    # The mapping stays valid after the temporary file is removed
+    with tempfile.NamedTemporaryFile(prefix="spearman_", suffix=".dat") as fout:
+        return np.memmap(fout, dtype=np.float64, mode="w+", shape=(size,))
+
+
+def _rank_columns(values):
+    """
+    Vectorized version of scipy.stats.rankdata(method="average") along
+    the first axis.
+    """
+    nr_rows = values.shape[0]
+    order = np.argsort(values, axis=0, kind="mergesort")
+    sorted_values = np.take_along_axis(values, order, axis=0)
+
+    positions = np.broadcast_to(np.arange(nr_rows)[:, np.newaxis], values.shape)
+    first_in_group = np.ones(values.shape, dtype=bool)
+    first_in_group[1:] = sorted_values[1:] != sorted_values[:-1]
+    last_in_group = np.ones(values.shape, dtype=bool)
+    last_in_group[:-1] = first_in_group[1:]
+
+    group_start = np.maximum.accumulate(np.where(first_in_group, positions, 0), axis=0)
+    group_end = np.minimum.accumulate(
+        np.where(last_in_group, positions, nr_rows - 1)[::-1], axis=0
+    )[::-1]
+
+    ranks = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, (group_start + group_end) / 2.0 + 1.0, axis=0)
+    return ranks
+
+
+def _standardize(values):
+    centered = values - values.mean(axis=0)
+    norm = np.sqrt(np.einsum("ij,ij->j", centered, centered))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(norm > 0, centered / norm, np.nan)
+
+
+def _clip_correlation(correlation):
+    return np.clip(correlation, -1.0, 1.0, out=correlation)
+
+
+def _column_chunks(nr_columns, chunk_size=None):
+    chunk_size = chunk_size or _RANK_CHUNK_SIZE
+    return [
+        slice(start, min(start + chunk_size, nr_columns))
+        for start in range(0, nr_columns, chunk_size)
+    ]
+
+
+def _default_n_jobs(n_jobs):
+    if n_jobs is None:
+        return multiprocessing.cpu_count()
+    return max(1, n_jobs)
+
+
+def _parallel_map(func, items, n_jobs=None):
+    """
+    Maps func over items on a pool of threads, the heavy lifting is done
+    in numpy which releases the GIL.
+    """
+    n_jobs = min(_default_n_jobs(n_jobs), len(items))
+    if n_jobs <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(n_jobs)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
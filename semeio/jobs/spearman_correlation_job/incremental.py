@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from semeio.jobs.spearman_correlation_job.clustering import (
+    correlation_distance_rows,
+    linkage_from_tree,
+    minimum_spanning_tree,
+    update_minimum_spanning_tree,
+)
+from semeio.jobs.spearman_correlation_job.correlation import standardized_ranks
+
+# Number of realizations each value is ranked against in IncrementalSpearman
+REFERENCE_SIZE = 20
+
+
+class IncrementalSpearman(object):
+    def __init__(self, reference_size=REFERENCE_SIZE):
+        """
+        Approximate Spearman correlation of simulated data that grows by
+        realizations, as the realizations of an ensemble finish. Each value is
+        ranked among the values of the first reference_size realizations of
+        its column, so the rank of a realization does not change when later
+        realizations are added. The sums of the ranks and of their cross
+        products are updated as realizations are added, and the correlation
+        matrix is found from the sums in O(n^2) when the ensemble is
+        complete, instead of O(n^2 r) from the ranks. With at least as many
+        reference realizations as realizations, the correlation is exact.
+        """
+        self.reference_size = reference_size
+        self._reset()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _reset(self):
+        self.index = pd.Index([])
+        self.columns = None
+        self._reference = None
+        self._pending = []
+        self._count = 0
+        self._sums = None
+        self._products = None
+
+    def update(self, data):
+        """
+        Adds the realizations (rows) of data that have not been added before,
+        and returns the number added. Realizations with missing values are
+        not added. If the observations (columns) have changed, the tracking
+        starts over from data.
+        """
+        if self.columns is not None and not self.columns.equals(data.columns):
+            print("The observations have changed, the ranking starts over")
+            self._reset()
+        if self.columns is None:
+            self.columns = data.columns
+            self._sums = np.zeros(len(data.columns))
+            self._products = np.zeros((len(data.columns), len(data.columns)))
+
+        values = np.asarray(data.values, dtype=np.float64)
+        new = ~data.index.isin(self.index) & ~np.isnan(values).any(axis=1)
+        self.index = self.index.append(data.index[new])
+        self._pending.extend(values[new])
+        if self._reference is None and len(self.index) >= self.reference_size:
+            self._set_reference()
+        if self._reference is not None:
+            self._add_pending()
+        return int(new.sum())
+
+    def matches(self, data):
+        """
+        True if the added realizations are those of data, and all the
+        observations of data are tracked.
+        """
+        return (
+            self.columns is not None
+            and len(self.index) == len(data.index)
+            and self.index.isin(data.index).all()
+            and (self.columns.get_indexer(data.columns) >= 0).all()
+        )
+
+    def correlation(self, columns):
+        """
+        The correlation matrix of the observations in columns. Observations
+        whose ranks do not vary are uncorrelated with the others.
+        """
+        if self._reference is None:
+            self._set_reference()
+            self._add_pending()
+        positions = self.columns.get_indexer(columns)
+        mean = self._sums[positions] / self._count
+        covariance = self._products[np.ix_(positions, positions)] / self._count
+        covariance -= np.outer(mean, mean)
+        std = np.sqrt(np.clip(np.diag(covariance), 0.0, None))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlation = covariance / np.outer(std, std)
+        correlation[~np.isfinite(correlation)] = 0.0
+        np.fill_diagonal(correlation, 1.0)
+        return np.clip(correlation, -1.0, 1.0, out=correlation)
+
+    def _set_reference(self):
+        self._reference = np.array(self._pending[: self.reference_size])
+
+    def _add_pending(self):
+        if not self._pending:
+            return
+        ranks = np.array([self._rank(row) for row in self._pending])
+        self._sums += ranks.sum(axis=0)
+        self._products += np.dot(ranks.T, ranks)
+        self._count += len(ranks)
+        self._pending = []
+
+    def _rank(self, row):
+        """
+        The average rank of each value of row among the reference values of
+        its column.
+        """
+        below = (self._reference < row).sum(axis=0)
+        equal = (self._reference == row).sum(axis=0)
+        return below + 0.5 * equal
+
+
+class ObservationState(object):
+    def __init__(self, cache, data):
+        """
+        Standardized ranks and minimum spanning trees of the observations from
+        earlier runs on the same realizations, persisted in a SpearmanCache.
+        Observations are matched by a hash of their key, data index and
+        values, so when observations are added or removed only the new ones
+        are ranked, and the tree is updated instead of computed again. The
+        state is only stored again when the observations have changed.
+        """
+        self.cache = cache
+        self.data = data
+        self.key = _state_key(data.index)
+        self.hashes = column_hashes(data)
+
+    def standardized_ranks(self):
+        """
+        The standardized ranks of the data, only new observations are ranked.
+        """
+        previous_points, previous_ranks, changed = self._previous("hashes", "ranks")
+        kept = previous_points >= 0
+        ranks = np.empty(self.data.shape, dtype=np.float64)
+        if kept.any():
+            ranks[:, kept] = previous_ranks[:, previous_points[kept]]
+        if not kept.all():
+            ranks[:, ~kept] = standardized_ranks(self.data.values[:, ~kept])
+
+        print(
+            "Ranked {} new observations, reused the ranks of {}".format(
+                (~kept).sum(), kept.sum()
+            )
+        )
+        if changed:
+            self.cache.store(self.key, "ranks", ranks)
+            self.cache.store(self.key, "hashes", self.hashes)
+        return ranks
+
+    def single_linkage(self, ranks, distance):
+        """
+        Single linkage on the correlation distance, absolute or signed, from
+        the minimum spanning tree of the previous observations.
+        """
+        nr_points = ranks.shape[1]
+        distance_row = correlation_distance_rows(ranks, distance == "absolute")
+        previous_points, previous_edges, changed = self._previous(
+            "hashes_" + distance, "edges_" + distance
+        )
+        if (previous_points >= 0).any():
+            edges, nr_rows = update_minimum_spanning_tree(
+                np.asarray(previous_edges), previous_points, distance_row
+            )
+        else:
+            edges, nr_rows = minimum_spanning_tree(nr_points, distance_row), nr_points
+
+        print(
+            "Minimum spanning tree updated with {} of {} distance rows".format(
+                nr_rows, nr_points
+            )
+        )
+        if changed:
+            self.cache.store(self.key, "edges_" + distance, edges)
+            self.cache.store(self.key, "hashes_" + distance, self.hashes)
+        return linkage_from_tree(nr_points, edges)
+
+    def _previous(self, hashes_name, name):
+        """
+        The position of each observation among the previous observations, or
+        -1 if new, the array stored for the previous observations, and whether
+        the observations differ from the previous ones.
+        """
+        previous_hashes = self.cache.load(self.key, hashes_name)
+        previous = self.cache.load(self.key, name, mmap=name == "ranks")
+        if previous_hashes is None or previous is None:
+            return np.full(len(self.hashes), -1, dtype=np.intp), None, True
+        positions = pd.Index(np.asarray(previous_hashes)).get_indexer(self.hashes)
+        changed = not np.array_equal(np.asarray(previous_hashes), self.hashes)
+        return positions, previous, changed
+
+
+def column_hashes(data):
+    """
+    Hash of the column header and values of each column of data.
+    """
+    values = np.asfortranarray(data.values, dtype=np.float64)
+    hashes = []
+    for nr, column in enumerate(data.columns):
+        sha = hashlib.sha1(repr(column).encode("utf-8"))
+        sha.update(values[:, nr].tobytes())
+        hashes.append(sha.hexdigest())
+    return np.array(hashes)
+
+
+def _state_key(index):
+    sha = hashlib.sha1(b"observation_state")
+    sha.update(repr(list(index)).encode("utf-8"))
+    return sha.hexdigest()
@@ -1,75 +1,542 @@
 # -*- coding: utf-8 -*-
-import itertools
+import time
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
 
 from ert_data.measured import MeasuredData
+from res.enkf import RealizationStateEnum
 from scipy.cluster.hierarchy import linkage, fcluster
-from semeio.jobs.correlated_observations_scaling.job import scaling_job
+from scipy.sparse import csr_matrix, save_npz
+from scipy.spatial.distance import squareform
+from semeio.jobs.correlated_observations_scaling.catalog import ObservationCatalog
+from semeio.jobs.correlated_observations_scaling.job import _update_scaling
+from semeio.jobs.correlated_observations_scaling.deduplication import (
+    duplicates_report,
+    find_duplicates,
+)
+from semeio.jobs.correlated_observations_scaling.job_config import (
+    get_default_values,
+)
+from semeio.jobs.correlated_observations_scaling.overlay import ScalingOverlay
+from semeio.jobs.correlated_observations_scaling.parallel import primary_components
+from semeio.jobs.correlated_observations_scaling.scaled_matrix import DataMatrix
+from semeio.jobs.spearman_correlation_job.clustering import (
+    condensed_distance_rows,
+    correlation_distance_rows,
+    graph_clusters,
+    linkage_from_tree,
+    minimum_spanning_tree,
+    nn_chain_merges,
+    search_threshold,
+    single_linkage,
+    split_clusters,
+)
+from semeio.jobs.spearman_correlation_job.correlation import (
+    DEFAULT_MEMORY_BUDGET,
+    approximate_correlation_graph,
+    column_ranks,
+    condensed_correlation_distance,
+    condensed_row_distance,
+    correlation_graph,
+    spearman_correlation_matrix,
+    standardized_ranks,
+    top_correlations,
+)
+from semeio.jobs.spearman_correlation_job.incremental import (
+    IncrementalSpearman,
+    ObservationState,
+)
+from semeio.jobs.spearman_correlation_job.output import (
+    write_clusters,
+    write_top_partners,
+)
+from semeio.jobs.spearman_correlation_job.partition import (
+    partition_labels,
+    partitioned_clusters,
+)
+from semeio.jobs.spearman_correlation_job.resampling import (
+    adjusted_rand_index,
+    bootstrap_consensus,
+    subsample_realizations,
+)
+
 
+# Distances between observations used for clustering, "legacy" is the euclidean
+# distance between the rows of the correlation matrix.
+DISTANCES = ("legacy", "absolute", "signed")
+# Default threshold on the inconsistency coefficient of the legacy distance,
+# the correlation distances have no default as their scale is different
+LEGACY_THRESHOLD = 1.15
+# Methods for hierarchical clustering, average and complete use a nearest
+# neighbour chain on the condensed distances
+LINKAGE_METHODS = ("single", "average", "complete")
+# "graph" forms clusters from the connected components of the observations
+# with an absolute correlation above a cutoff, no dendrogram is computed.
+CLUSTERING_METHODS = ("hierarchical", "graph")
+# Default absolute correlation cutoff of the graph clustering
+MIN_CORRELATION = 0.9
 
-def spearman_job(facade, threshold, dry_run):
+_SCALING_DEFAULTS = get_default_values()["CALCULATE_KEYS"]
+_PCA_THRESHOLD = _SCALING_DEFAULTS["threshold"]
 
+
+def spearman_job(facade, threshold, dry_run, **kwargs):
+    """
+    Clusters all the observations of the case, keyword arguments are passed on
+    to _spearman_correlation.
+    """
     observation_keys = [
         facade.get_observation_key(nr) for nr, _ in enumerate(facade.get_observations())
     ]
 
-    _spearman_correlation(facade, observation_keys, threshold, dry_run)
+    _spearman_correlation(facade, observation_keys, threshold, dry_run, **kwargs)
 
 
-def _spearman_correlation(facade, obs_keys, threshold, dry_run):
+def _spearman_correlation(
+    facade,
+    obs_keys,
+    threshold,
+    dry_run,
+    memory_budget=None,
+    distance="legacy",
+    clustering="hierarchical",
+    min_correlation=None,
+    approximate_recall=None,
+    sweep=None,
+    auto_threshold_clusters=None,
+    auto_threshold_max_size=None,
+    cache=None,
+    output_file=None,
+    partition=None,
+    partition_map=None,
+    subsample=None,
+    stratified_subsample=False,
+    seed=None,
+    bootstrap=None,
+    consensus_level=0.5,
+    consensus_file=None,
+    deduplicate=False,
+    duplicate_tolerance=None,
+    max_cluster_size=None,
+    linkage_method="single",
+    top_partners=None,
+    top_partners_file="top_partners.npz",
+    jobs=None,
+    watch=None,
+    watch_timeout=None,
+):
     """
     Collects data, performs scaling and applies scaling, assumes validated input.
+    If a SpearmanCache is given, linkage matrices are reused from earlier runs
+    on the same simulated data, and when observations were added or removed
+    since an earlier run on the same realizations, only the changed
+    observations are ranked and the minimum spanning tree is updated. With
+    subsample, the clustering is done on a subset of the realizations, while
+    the scaling factors are calculated from all of them. With bootstrap, the
+    clusters are the consensus of clustering that number of bootstrap
+    resamples of the realizations. With deduplicate, observations
+    with identical ranks (or within duplicate_tolerance) are clustered once
+    and share the cluster of their representative. Clusters larger than
+    max_cluster_size are split along the dendrogram, with bootstrap the
+    clusters of each resample are split instead. linkage_method is the
+    hierarchical clustering method, single, average or complete. With
+    top_partners, the top_partners most correlated partners of every
+    observation are written to top_partners_file instead of clustering. The
+    scaling factors of the clusters are calculated in jobs processes if given.
+    With watch, the storage is polled every watch seconds while the ensemble
+    runs, and an approximate Spearman correlation is accumulated as the
+    realizations finish, see IncrementalSpearman. The clustering is done from
+    it when all realizations have data, or after watch_timeout seconds.
     """
-    measured_data = MeasuredData(facade, obs_keys)
-    measured_data.remove_failed_realizations()
-    measured_data.remove_inactive_observations()
-    measured_data.filter_ensemble_std(1.0e-6)
+    # Only plain hierarchical clustering has a dendrogram to sweep or search,
+    # with bootstrap the dendrograms of the resamples are split
+    hierarchical = (
+        clustering == "hierarchical" and partition is None and bootstrap is None
+    )
+    if not hierarchical:
+        if sweep or auto_threshold_clusters or auto_threshold_max_size:
+            raise ValueError(
+                "Threshold sweep and search require hierarchical clustering "
+                "without partition or bootstrap"
+            )
+    if linkage_method != "single" and not hierarchical:
+        raise ValueError(
+            "Average and complete linkage require hierarchical clustering "
+            "without partition or bootstrap"
+        )
+    if max_cluster_size is not None and (
+        clustering != "hierarchical" or partition is not None
+    ):
+        raise ValueError(
+            "A maximum cluster size requires hierarchical clustering without "
+            "partition"
+        )
+    if clustering != "graph":
+        if min_correlation is not None or approximate_recall is not None:
+            raise ValueError(
+                "A minimum correlation and approximate recall require graph "
+                "clustering"
+            )
+    elif min_correlation is None:
+        min_correlation = MIN_CORRELATION
+    if partition == "pattern" and not partition_map:
+        raise ValueError("Pattern partitions require a --partition-map")
+    if watch is not None and not (
+        hierarchical
+        and linkage_method == "single"
+        and subsample is None
+        and not deduplicate
+        and top_partners is None
+        and cache is None
+    ):
+        raise ValueError(
+            "Watching the ensemble requires single linkage hierarchical "
+            "clustering without partition, bootstrap, subsample, deduplicate, "
+            "top partners or cache"
+        )
+    threshold = _clustering_threshold(
+        threshold,
+        distance,
+        clustering == "hierarchical"
+        and top_partners is None
+        and not sweep
+        and not (auto_threshold_clusters or auto_threshold_max_size),
+    )
+
+    tracker = None
+    if watch is not None:
+        tracker = _watch_realizations(
+            facade, obs_keys, watch, watch_timeout, memory_budget
+        )
+
+    measured_data = _load_measured_data(facade, obs_keys, tracker)
 
     simulated_data = measured_data.get_simulated_data()
+    random_state = np.random.RandomState(seed)
+    if subsample is not None:
+        sample = subsample_realizations(
+            simulated_data.index, subsample, stratified_subsample, random_state
+        )
+        simulated_data = simulated_data.loc[sample]
+
+    fingerprint = cache.fingerprint(simulated_data) if cache is not None else None
+    if tracker is not None and not tracker.matches(simulated_data):
+        print("The watched realizations do not match the data, ranking it again")
+        tracker = None
+    ranks = None
+    state = None
+    if tracker is None and not np.isnan(simulated_data.values).any():
+        if cache is not None:
+            state = ObservationState(cache, simulated_data)
+        ranks = _standardized_ranks(simulated_data, state)
+
+    if top_partners is not None:
+        if ranks is None:
+            raise ValueError("Top partners are not available with missing data")
+        partners, correlations = top_correlations(
+            ranks,
+            top_partners,
+            absolute=distance != "signed",
+            memory_budget=memory_budget,
+        )
+        write_top_partners(
+            top_partners_file, simulated_data.columns, partners, correlations
+        )
+        return
+
+    duplicates = None
+    if deduplicate and ranks is not None and bootstrap is None:
+        if duplicate_tolerance and distance == "legacy":
+            raise ValueError("Merging near duplicates requires a correlation distance")
+        duplicates = find_duplicates(ranks, duplicate_tolerance)
+        print(duplicates_report(duplicates))
+
+    linkage_matrix = None
+    if hierarchical:
+        linkage_name = "linkage_{}".format(distance)
+        if linkage_method != "single":
+            linkage_name += "_{}".format(linkage_method)
+        if duplicate_tolerance and duplicates is not None:
+            linkage_name += "_{}".format(duplicate_tolerance)
+        if tracker is not None:
+            linkage_matrix = _linkage_from_correlation(
+                tracker.correlation(simulated_data.columns), distance
+            )
+        else:
+            linkage_matrix = _cached(
+                cache,
+                fingerprint,
+                linkage_name,
+                lambda: _calculate_linkage(
+                    simulated_data,
+                    ranks,
+                    distance,
+                    memory_budget,
+                    state,
+                    duplicates,
+                    linkage_method,
+                ),
+            )
+        if sweep:
+            _threshold_sweep(measured_data, linkage_matrix, sweep, distance, jobs)
+            return
+        if auto_threshold_clusters or auto_threshold_max_size:
+            threshold = search_threshold(
+                linkage_matrix,
+                _criterion(distance),
+                max_clusters=auto_threshold_clusters,
+                max_cluster_size=auto_threshold_max_size,
+            )
+            print("Threshold found by search: {}".format(threshold))
 
-    correlation_matrix = _calculate_correlation_matrix(simulated_data)
+    def _find_clusters(data, ranks, linkage_matrix=None, consensus_file=None):
+        if clustering == "graph":
+            graph = _calculate_graph(
+                data, ranks, min_correlation, memory_budget, approximate_recall, seed
+            )
+            return graph_clusters(graph)
+        if bootstrap is not None:
+            return _consensus_cluster_analysis(
+                data,
+                threshold,
+                distance,
+                bootstrap,
+                consensus_level,
+                random_state,
+                consensus_file,
+                max_cluster_size,
+            )
+        if partition is not None:
+            return _partitioned_cluster_analysis(
+                data, ranks, threshold, distance, partition, partition_map, seed
+            )
+        if linkage_matrix is None:
+            linkage_matrix = _calculate_linkage(
+                data, ranks, distance, memory_budget, method=linkage_method
+            )
+        return _cluster_analysis(linkage_matrix, threshold, distance)
 
-    clusters = _cluster_analysis(correlation_matrix, threshold)
+    if duplicates is not None and linkage_matrix is None:
+        unique = duplicates.representatives
+        clusters = _find_clusters(simulated_data.iloc[:, unique], ranks[:, unique])
+        clusters = clusters[duplicates.groups]
+    else:
+        clusters = _find_clusters(simulated_data, ranks, linkage_matrix, consensus_file)
 
-    columns = correlation_matrix.columns
+    if subsample is not None:
+        # A second, independent, subsample shows how stable the clustering is
+        second_sample = subsample_realizations(
+            measured_data.get_simulated_data().index,
+            subsample,
+            stratified_subsample,
+            random_state,
+            exclude=simulated_data.index,
+        )
+        second_data = measured_data.get_simulated_data().loc[second_sample]
+        second_ranks = None
+        if not np.isnan(second_data.values).any():
+            second_ranks = standardized_ranks(second_data.values)
+        second_clusters = _find_clusters(second_data, second_ranks)
+        print(
+            "Clustering on {} of {} realizations, adjusted Rand index between "
+            "two independent subsamples: {:.3f}".format(
+                len(simulated_data.index),
+                len(measured_data.get_simulated_data().index),
+                adjusted_rand_index(clusters, second_clusters),
+            )
+        )
+
+    if max_cluster_size is not None and bootstrap is None:
+        clusters, nr_splits = split_clusters(linkage_matrix, clusters, max_cluster_size)
+        print(
+            "Split oversized clusters {} times, largest cluster: {}".format(
+                nr_splits, np.bincount(clusters).max()
+            )
+        )
+
+    columns = simulated_data.columns
 
     # Here the clusters are joined with the key and data index
     # to group the observations, the column level values are the column
     # headers, where key_index is the observation key and data_index
     # is a range.
-    data = list(
-        zip(
-            clusters,
-            columns.get_level_values(0),
-            columns.get_level_values("data_index"),
-        )
+    clustered_data = _cluster_data(
+        clusters,
+        columns.get_level_values(0),
+        columns.get_level_values("data_index"),
     )
 
-    clustered_data = _cluster_data(data)
-
     job_configs = _config_creation(clustered_data)
 
     _output_clusters(clustered_data)
 
+    if output_file is not None:
+        write_clusters(clustered_data, output_file)
+
     if not dry_run:
-        _run_scaling(facade, job_configs)
+        _run_scaling(facade, measured_data, clusters, job_configs, jobs)
+
+
+def _clustering_threshold(threshold, distance, required):
+    """
+    The legacy distance defaults to LEGACY_THRESHOLD. For the correlation
+    distances the threshold is a cophenetic distance of at most 1 (2 if
+    signed), and must be given when the dendrogram is cut at it.
+    """
+    if threshold is not None:
+        return threshold
+    if distance == "legacy":
+        return LEGACY_THRESHOLD
+    if required:
+        raise ValueError(
+            "A threshold is required with the {} distance".format(distance)
+        )
+    return None
+
+
+def _load_measured_data(facade, obs_keys, tracker=None):
+    """
+    The measured data of the realizations with data. If an IncrementalSpearman
+    is given, the realizations it has not seen are added to it before the
+    observations without ensemble spread are filtered out.
+    """
+    measured_data = _active_measured_data(facade, obs_keys)
+    if tracker is not None:
+        tracker.update(measured_data.get_simulated_data())
+    measured_data.filter_ensemble_std(1.0e-6)
+    return measured_data
+
+
+def _active_measured_data(facade, obs_keys):
+    measured_data = MeasuredData(facade, obs_keys)
+    measured_data.remove_failed_realizations()
+    measured_data.remove_inactive_observations()
+    return measured_data
+
+
+def _watch_realizations(
+    facade, obs_keys, poll_interval, timeout=None, memory_budget=None
+):
+    """
+    Polls the storage of the current case every poll_interval seconds, and
+    adds the realizations with data to an IncrementalSpearman. The data is
+    loaded when a tenth of the ensemble has finished since the last load.
+    Returns the IncrementalSpearman when all realizations have data, or when
+    timeout seconds have passed, and None if its n x n sums of products do
+    not fit within memory_budget.
+    """
+    memory_budget = memory_budget or DEFAULT_MEMORY_BUDGET
+    ensemble_size = facade.get_ensemble_size()
+    batch_size = max(1, ensemble_size // 10)
+    tracker = IncrementalSpearman()
+    start = time.time()
+    nr_loaded = 0
+    while True:
+        nr_finished = len(
+            facade.get_current_fs().realizationList(RealizationStateEnum.STATE_HAS_DATA)
+        )
+        if nr_finished >= ensemble_size or nr_finished - nr_loaded >= batch_size:
+            nr_loaded = nr_finished
+            simulated_data = _active_measured_data(
+                facade, obs_keys
+            ).get_simulated_data()
+            if simulated_data.shape[1] ** 2 * 8 > memory_budget:
+                print(
+                    "The correlation of {} observations does not fit in the "
+                    "memory budget, not watching the ensemble".format(
+                        simulated_data.shape[1]
+                    )
+                )
+                return None
+            nr_new = tracker.update(simulated_data)
+            print(
+                "Added {} new realizations, {} of {} realizations have "
+                "data".format(nr_new, nr_finished, ensemble_size)
+            )
+        if nr_finished >= ensemble_size:
+            return tracker
+        if timeout is not None and time.time() - start >= timeout:
+            print("Stopped waiting for realizations after {} seconds".format(timeout))
+            return tracker
+        time.sleep(poll_interval)
+
+
+def _standardized_ranks(data, state=None):
+    if state is not None:
+        return state.standardized_ranks()
+    return standardized_ranks(data.values)
+
+
+def _cached(cache, fingerprint, name, compute):
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(fingerprint, name, compute)
 
 
 def _output_clusters(clustered_data):
     for cluster, val in clustered_data.items():
+        val = {key: np.asarray(index).tolist() for key, index in val.items()}
         print("Cluster nr: {}, clustered data: {}".format(cluster, val))
 
 
-def _run_scaling(facade, job_configs):
-    for job in job_configs:
-        scaling_job(facade, job)
+def _run_scaling(facade, measured_data, clusters, job_configs, jobs=None):
+    """
+    Calculates the scaling factor of every cluster from the data that is
+    already loaded, instead of loading the data again per cluster. The factors
+    of all clusters are recorded in one overlay and applied at the end. The
+    job configs are in the same order as the sorted clusters.
+    """
+    data_matrix, calculated = _scaling_data(measured_data)
+    factors = _cluster_scaling_factors(data_matrix, clusters[calculated], jobs=jobs)
+
+    observations = facade.get_observations()
+    overlay = ScalingOverlay(observations, ObservationCatalog(facade))
+    for cluster, job in zip(np.unique(clusters), job_configs):
+        if cluster not in factors:
+            print("Cluster nr: {} not scaled, all data filtered out".format(cluster))
+            continue
+        print("Scaling factor calculated from cluster nr: {}".format(cluster))
+        events = [
+            _update_key(entry["key"], entry["index"])
+            for entry in job["CALCULATE_KEYS"]["keys"]
+        ]
+        _update_scaling(observations, factors[cluster], events, overlay)
+    overlay.commit()
+
+
+def _update_key(key, index, update_key=namedtuple("UpdateKey", ["key", "index"])):
+    return update_key(key, index)
+
+
+def _cluster_data(clusters, keys, data_index):
+    """
+    Groups the observations by cluster and observation key, and returns
+    cluster -> key -> sorted array of data indexes. The keys are integer
+    coded and grouped with a single lexsort, so no python objects are
+    created per observation.
+    """
+    if len(clusters) == 0:
+        return {}
+
+    key_codes, key_names = pd.factorize(np.asarray(keys), sort=True)
+    clusters = np.asarray(clusters)
+    data_index = np.asarray(data_index)
 
+    order = np.lexsort((data_index, key_codes, clusters))
+    clusters, key_codes = clusters[order], key_codes[order]
+    boundaries = np.flatnonzero(
+        (clusters[1:] != clusters[:-1]) | (key_codes[1:] != key_codes[:-1])
+    )
+    boundaries += 1
 
-def _cluster_data(data):
+    starts = np.r_[0, boundaries]
     groups = {}
-    for (nr, key), cluster_group in itertools.groupby(sorted(data), key=lambda x: (x[0], x[1])):
-        if nr not in groups:
-            groups[nr] = {}
-        groups[nr].update({key: [index for _, _, index in cluster_group]})
+    for start, index in zip(starts, np.split(data_index[order], boundaries)):
+        cluster = int(clusters[start])
+        groups.setdefault(cluster, {})[key_names[key_codes[start]]] = index
     return groups
 
 
@@ -79,7 +546,10 @@ def _config_creation(clusters):
         config.append(
             {
                 "CALCULATE_KEYS": {
-                    "keys": [{"key": key, "index": val} for key, val in cluster.items()]
+                    "keys": [
+                        {"key": key, "index": np.asarray(val).tolist()}
+                        for key, val in cluster.items()
+                    ]
                 }
             }
         )
@@ -87,12 +557,282 @@ def _config_creation(clusters):
 
 
 def _calculate_correlation_matrix(data):
-    # Spearman correlation is quite slow, but will be improved in a future version
-    # of pandas (https://github.com/pandas-dev/pandas/pull/28151), for now this is
-    # equivalent:
-    return data.rank().corr(method="pearson")
+    # Equivalent to data.rank().corr(method="pearson"), which is too slow for
+    # large numbers of observations.
+    return spearman_correlation_matrix(data)
 
 
-def _cluster_analysis(correlation_matrix, threshold):
-    a = linkage(correlation_matrix, "single")
-    return fcluster(a, threshold)
+def _calculate_linkage(
+    data,
+    ranks,
+    distance="legacy",
+    memory_budget=None,
+    state=None,
+    duplicates=None,
+    method="single",
+):
+    """
+    Hierarchical clustering of the observations, single linkage by default.
+    With the legacy distance the rows of the correlation matrix are clustered
+    as feature vectors, the distances between them are computed block by
+    block within memory_budget. Otherwise the correlation distance, 1 - |rho|
+    or 1 - rho, is used directly and the minimum spanning tree is found
+    without storing the distances, or updated from the persisted
+    ObservationState if given. Average and complete linkage use the nearest
+    neighbour chain algorithm on the condensed distances. The ranks are None
+    if the data contains NaN.
+    """
+    if duplicates is not None:
+        return _deduplicated_linkage(ranks, distance, duplicates, memory_budget, method)
+    if ranks is None:
+        # Pairwise complete observations are needed, use the dense matrix
+        return _linkage_from_correlation(
+            _calculate_correlation_matrix(data).values, distance, method
+        )
+
+    nr_points = ranks.shape[1]
+    if method != "single":
+        distances = _condensed_distance(ranks, distance, memory_budget)
+        return linkage_from_tree(
+            nr_points, nn_chain_merges(distances, nr_points, method)
+        )
+    if distance == "legacy":
+        return linkage(
+            condensed_row_distance(ranks, memory_budget=memory_budget), "single"
+        )
+    if state is not None:
+        return state.single_linkage(ranks, distance)
+    return single_linkage(
+        nr_points, correlation_distance_rows(ranks, distance == "absolute")
+    )
+
+
+def _linkage_from_correlation(correlation_matrix, distance, method="single"):
+    if distance == "legacy":
+        return linkage(correlation_matrix, method)
+    distances = _correlation_distance(correlation_matrix, distance)
+    return linkage(squareform(distances, checks=False), method)
+
+
+def _condensed_distance(ranks, distance, memory_budget=None, weights=None):
+    if distance == "legacy":
+        return condensed_row_distance(
+            ranks, weights=weights, memory_budget=memory_budget
+        )
+    return condensed_correlation_distance(
+        ranks, absolute=distance == "absolute", memory_budget=memory_budget
+    )
+
+
+def _deduplicated_linkage(
+    ranks, distance, duplicates, memory_budget=None, method="single"
+):
+    """
+    Hierarchical clustering of the representatives of the duplicates only.
+    Each duplicate is then joined to its representative, at distance zero for
+    exact duplicates, which gives the same dendrogram as clustering all the
+    observations. For the legacy distance every row of the correlation matrix
+    is weighted by the number of duplicates it stands for, and for average
+    linkage every representative starts with the size of its group.
+    """
+    unique = duplicates.representatives
+    unique_ranks = ranks[:, unique]
+    nr_unique = len(unique)
+    edges = np.empty((0, 3))
+    if nr_unique > 1 and method != "single":
+        distances = _condensed_distance(
+            unique_ranks, distance, memory_budget, duplicates.counts
+        )
+        edges = nn_chain_merges(distances, nr_unique, method, duplicates.counts)
+    elif nr_unique > 1:
+        if distance == "legacy":
+            distances = condensed_row_distance(
+                unique_ranks, weights=duplicates.counts, memory_budget=memory_budget
+            )
+            distance_row = condensed_distance_rows(distances, nr_unique)
+        else:
+            distance_row = correlation_distance_rows(
+                unique_ranks, distance == "absolute"
+            )
+        edges = minimum_spanning_tree(nr_unique, distance_row)
+    edges[:, :2] = unique[edges[:, :2].astype(np.intp)]
+
+    members = np.setdiff1d(np.arange(ranks.shape[1]), unique)
+    representatives = unique[duplicates.groups[members]]
+    if distance == "legacy":
+        # Only exact duplicates, their rows of the correlation matrix are equal
+        member_distances = np.zeros(len(members))
+    else:
+        correlation = np.einsum(
+            "ij,ij->j", ranks[:, members], ranks[:, representatives]
+        )
+        member_distances = _correlation_distance(
+            np.clip(correlation, -1.0, 1.0), distance
+        )
+    member_edges = np.column_stack((representatives, members, member_distances))
+    return linkage_from_tree(ranks.shape[1], np.vstack((edges, member_edges)))
+
+
+def _calculate_graph(
+    data, ranks, min_correlation, memory_budget=None, approximate_recall=None, seed=None
+):
+    """
+    Sparse graph connecting observations with an absolute Spearman correlation
+    of at least min_correlation. If approximate_recall is given, only candidate
+    pairs from locality sensitive hashing are checked, and pairs at the cutoff
+    are found with approximately that probability.
+    """
+    if ranks is None:
+        correlation_matrix = _calculate_correlation_matrix(data).values
+        return csr_matrix(np.triu(np.abs(correlation_matrix) >= min_correlation, k=1))
+
+    if approximate_recall is not None:
+        graph, _ = approximate_correlation_graph(
+            ranks, min_correlation, recall=approximate_recall, seed=seed
+        )
+        return graph
+    return correlation_graph(ranks, min_correlation, memory_budget=memory_budget)
+
+
+def _partitioned_cluster_analysis(
+    data, ranks, threshold, distance, partition, partition_map=None, seed=None
+):
+    """
+    Clusters within partitions of the observations first, and then merges the
+    clusters of all partitions, see partitioned_clusters.
+    """
+    if distance == "legacy":
+        raise ValueError("Partitioned clustering requires a correlation distance")
+    if ranks is None:
+        raise ValueError("Partitioned clustering is not possible with missing data")
+    partitions = partition_labels(
+        data.columns, partition, pattern_map=partition_map, ranks=ranks, seed=seed
+    )
+    return partitioned_clusters(
+        ranks, partitions, threshold, absolute=distance == "absolute"
+    )
+
+
+def _consensus_cluster_analysis(
+    data,
+    threshold,
+    distance,
+    nr_resamples,
+    consensus_level=0.5,
+    random_state=None,
+    consensus_file=None,
+    max_cluster_size=None,
+):
+    """
+    Consensus clustering over bootstrap resamples, see bootstrap_consensus.
+    The co-assignment frequencies are saved to consensus_file, as a scipy
+    sparse npz file, if given. The clusters of each resample are split to at
+    most max_cluster_size observations if given.
+    """
+    if distance == "legacy":
+        raise ValueError("Bootstrap clustering requires a correlation distance")
+    if np.isnan(data.values).any():
+        raise ValueError("Bootstrap clustering is not possible with missing data")
+    frequency, clusters = bootstrap_consensus(
+        column_ranks(data.values),
+        nr_resamples,
+        threshold,
+        absolute=distance == "absolute",
+        consensus_level=consensus_level,
+        random_state=random_state,
+        max_cluster_size=max_cluster_size,
+    )
+    if consensus_file is not None:
+        save_npz(consensus_file, frequency)
+    return clusters
+
+
+def _correlation_distance(correlation_matrix, distance):
+    if distance == "absolute":
+        correlation_matrix = np.abs(correlation_matrix)
+    return 1.0 - correlation_matrix
+
+
+def _criterion(distance):
+    """
+    The threshold is applied to the inconsistency coefficient for the legacy
+    distance, and to the cophenetic distance otherwise.
+    """
+    return "inconsistent" if distance == "legacy" else "distance"
+
+
+def _cluster_analysis(linkage_matrix, threshold, distance="legacy"):
+    return fcluster(linkage_matrix, threshold, criterion=_criterion(distance))
+
+
+def _threshold_sweep(
+    measured_data, linkage_matrix, thresholds, distance="legacy", jobs=None
+):
+    """
+    Cuts the same linkage at each threshold, and reports the number of
+    clusters, the cluster sizes and the resulting scaling factors.
+    """
+    data_matrix, calculated = _scaling_data(measured_data)
+    for threshold in thresholds:
+        clusters = _cluster_analysis(linkage_matrix, threshold, distance)
+        sizes = np.bincount(clusters)[1:]
+        sizes = sizes[sizes > 0]
+        factors = _cluster_scaling_factors(data_matrix, clusters[calculated], jobs=jobs)
+        print(
+            "Threshold: {}, clusters: {}, cluster size min/median/max: "
+            "{}/{}/{}, scaling factor min/median/max: {:.3f}/{:.3f}/{:.3f}".format(
+                threshold,
+                len(sizes),
+                sizes.min(),
+                np.median(sizes),
+                sizes.max(),
+                min(factors.values()),
+                np.median(list(factors.values())),
+                max(factors.values()),
+            )
+        )
+
+
+def _scaling_data(measured_data):
+    """
+    Applies the remaining filters of the scaling job to the loaded data and
+    normalizes it. Returns the normalized simulated data matrix and a mask
+    of which of the clustered columns are part of it.
+    """
+    columns = measured_data.data.columns
+    measured_data.filter_ensemble_mean_obs(_SCALING_DEFAULTS["alpha"])
+    measured_data.filter_ensemble_std(_SCALING_DEFAULTS["std_cutoff"])
+
+    matrix = DataMatrix(measured_data.data)
+    matrix.std_normalization(inplace=True)
+    calculated = columns.isin(measured_data.data.columns)
+    return matrix.get_data_matrix(), calculated
+
+
+def _cluster_scaling_factors(
+    data_matrix, clusters, threshold=_PCA_THRESHOLD, jobs=None
+):
+    """
+    Scaling factor for each cluster, from the columns of the normalized
+    data matrix belonging to the cluster. A single observation always gets
+    a scaling factor of 1. Duplicated columns are collapsed before the PCA.
+    The clusters are computed in jobs processes if given.
+    """
+    factors = {}
+    groups = []
+    for cluster in np.unique(clusters):
+        columns = np.flatnonzero(clusters == cluster)
+        if len(columns) == 1:
+            factors[cluster] = 1.0
+        else:
+            groups.append((cluster, columns))
+
+    components = primary_components(
+        data_matrix,
+        [columns for _, columns in groups],
+        [threshold] * len(groups),
+        jobs,
+    )
+    for (cluster, columns), (nr_components, _) in zip(groups, components):
+        factors[cluster] = np.sqrt(len(columns) / float(nr_components))
+    return factors
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import yaml
+
+
+def write_clusters(clustered_data, output_file):
+    """
+    Writes the clusters as a CORRELATED_OBSERVATIONS_SCALING job config with
+    one group per cluster. Each group is dumped as its own list item, so only
+    one cluster is held as a yaml document at a time.
+    """
+    with open(output_file, "w") as fout:
+        if not clustered_data:
+            yaml.safe_dump([], fout)
+        for cluster in clustered_data.values():
+            group = {
+                "CALCULATE_KEYS": {
+                    "keys": [
+                        {"key": key, "index": index_ranges(index)}
+                        for key, index in cluster.items()
+                    ]
+                }
+            }
+            yaml.safe_dump([group], fout, default_flow_style=False)
+    print("Clusters written to: {}".format(output_file))
+
+
+def index_ranges(index):
+    """
+    Compresses a list of indexes into the range format of the job config,
+    index_ranges([0, 1, 2, 5, 7, 8]) -> "0-2,5,7-8"
+    """
+    index = np.unique(index)
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    starts = index[np.r_[0, breaks]]
+    ends = index[np.r_[breaks - 1, len(index) - 1]]
+    return ",".join(
+        str(start) if start == end else "{}-{}".format(start, end)
+        for start, end in zip(starts, ends)
+    )
+
+
+def write_top_partners(output_file, columns, partners, correlations):
+    """
+    Writes the top correlated partners of each observation to an npz file
+    with the arrays key and data_index, one entry per observation, and the
+    (n, k) arrays partners, indexes into the observations, and correlation.
+    """
+    np.savez_compressed(
+        output_file,
+        key=np.array(columns.get_level_values(0), dtype=str),
+        data_index=np.asarray(columns.get_level_values("data_index")),
+        partners=partners,
+        correlation=correlations,
+    )
+    print("Top correlated partners written to: {}".format(output_file))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from scipy.cluster.hierarchy import fcluster
+from semeio.jobs.spearman_correlation_job.clustering import (
+    correlation_distance_rows,
+    single_linkage,
+)
+from semeio.jobs.spearman_correlation_job.correlation import signature_keys
+
+PARTITION_METHODS = ("key", "pattern", "sketch")
+
+_SKETCH_BITS = 8
+
+
+def partition_labels(columns, method="key", pattern_map=None, ranks=None, seed=None):
+    """
+    Assigns each observation (column) to a partition, returns an integer label
+    per column.
+        key: one partition per observation key.
+        pattern: pattern_map maps partition names to lists of key patterns, a
+            key belongs to the first partition with a matching pattern. Keys
+            not matching any pattern get a partition per key.
+        sketch: the sign bits of a few random projections of the ranks.
+    """
+    keys = np.asarray(columns.get_level_values(0))
+    if method == "key":
+        return pd.factorize(keys)[0]
+    if method == "pattern":
+        return pd.factorize(_pattern_partitions(keys, pattern_map))[0]
+    if method == "sketch":
+        random_state = np.random.RandomState(seed)
+        planes = random_state.standard_normal((_SKETCH_BITS, ranks.shape[0]))
+        return pd.factorize(signature_keys(ranks, planes))[0]
+    raise ValueError("Unknown partition method: {}".format(method))
+
+
+def _pattern_partitions(keys, pattern_map):
+    partitions = {}
+    for key in pd.unique(keys):
+        partitions[key] = key
+        for name, patterns in pattern_map.items():
+            if any(fnmatch.fnmatch(key, pattern) for pattern in patterns):
+                partitions[key] = name
+                break
+    return np.array([partitions[key] for key in keys], dtype=object)
+
+
+def partitioned_clusters(ranks, partitions, threshold, absolute=True, n_jobs=None):
+    """
+    Two level single linkage clustering. The observations in each partition
+    are clustered separately in worker processes, then the mean rank vectors
+    of the clusters found are clustered in a second, much smaller, pass. Both
+    passes cut the dendrogram at the same cophenetic distance. Returns cluster
+    numbers starting at 1, in the same way as fcluster.
+    """
+    members = [np.flatnonzero(partitions == label) for label in np.unique(partitions)]
+    tasks = [(ranks[:, columns], threshold, absolute) for columns in members]
+    local_clusters = _process_map(_cluster_partition, tasks, n_jobs)
+
+    clusters = np.empty(ranks.shape[1], dtype=np.intp)
+    representatives = []
+    for columns, labels in zip(members, local_clusters):
+        for label in np.unique(labels):
+            cluster_columns = columns[labels == label]
+            clusters[cluster_columns] = len(representatives)
+            representatives.append(_representative(ranks[:, cluster_columns], absolute))
+
+    print(
+        "Partitioned clustering: {} partitions, {} local clusters".format(
+            len(members), len(representatives)
+        )
+    )
+    merged = _cluster_partition((np.column_stack(representatives), threshold, absolute))
+    return merged[clusters]
+
+
+def _cluster_partition(task):
+    ranks, threshold, absolute = task
+    if ranks.shape[1] == 1:
+        return np.ones(1, dtype=np.intp)
+    linkage_matrix = single_linkage(
+        ranks.shape[1], correlation_distance_rows(ranks, absolute)
+    )
+    return fcluster(linkage_matrix, threshold, criterion="distance")
+
+
+def _representative(ranks, absolute):
+    """
+    Standardized mean rank vector of a cluster. With the absolute distance,
+    columns negatively correlated with the first column are flipped first
+    so they do not cancel.
+    """
+    if absolute:
+        ranks = ranks * np.where(np.dot(ranks[:, 0], ranks) < 0, -1.0, 1.0)
+    mean = ranks.mean(axis=1)
+    mean -= mean.mean()
+    norm = np.linalg.norm(mean)
+    return mean / norm if norm > 0 else ranks[:, 0]
+
+
+def _process_map(func, tasks, n_jobs=None):
+    n_jobs = min(n_jobs or multiprocessing.cpu_count(), len(tasks))
+    if n_jobs <= 1:
+        return [func(task) for task in tasks]
+
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from scipy.cluster.hierarchy import fcluster
+from scipy.sparse import csr_matrix, triu
+from semeio.jobs.spearman_correlation_job.clustering import (
+    correlation_distance_rows,
+    graph_clusters,
+    single_linkage,
+    split_clusters,
+)
+from semeio.jobs.spearman_correlation_job.correlation import standardized_ranks
+
+# A cluster of m observations stores m * m co-assigned pairs, a warning is
+# printed for resample clusters larger than this unless they are split
+LARGE_CLUSTER_SIZE = 2000
+
+# Ranked data shared with the bootstrap workers, set by _init_worker
+_shared_ranks = None
+
+
+def subsample_realizations(
+    realizations, size, stratified=False, random_state=None, exclude=None
+):
+    """
+    Draws size realizations without replacement, size can also be a fraction
+    of the number of realizations. With stratified, the sorted realizations
+    are split into size equally large strata and one realization is drawn
+    from each. Realizations in exclude are avoided if enough remain.
+    """
+    random_state = random_state or np.random.RandomState()
+    realizations = np.sort(np.asarray(realizations))
+    size = _sample_size(size, len(realizations))
+
+    if exclude is not None:
+        remaining = realizations[~np.isin(realizations, exclude)]
+        if len(remaining) >= size:
+            realizations = remaining
+
+    if stratified:
+        strata = np.array_split(realizations, size)
+        return np.array([random_state.choice(stratum) for stratum in strata])
+    return np.sort(random_state.choice(realizations, size, replace=False))
+
+
+def _sample_size(size, nr_realizations):
+    if size < 1:
+        size = int(round(size * nr_realizations))
+    if not 2 <= size <= nr_realizations:
+        raise ValueError(
+            "Subsample size must be between 2 and the number of realizations: "
+            "{}".format(nr_realizations)
+        )
+    return int(size)
+
+
+def adjusted_rand_index(first, second):
+    """
+    Adjusted Rand index between two clusterings of the same observations, 1.0
+    for identical clusterings and around 0.0 for independent ones.
+    """
+    _, first = np.unique(first, return_inverse=True)
+    _, second = np.unique(second, return_inverse=True)
+    pairs = first.astype(np.int64) * (second.max() + 1) + second
+    _, contingency = np.unique(pairs, return_counts=True)
+
+    index = _pairs(contingency).sum()
+    first_pairs = _pairs(np.bincount(first)).sum()
+    second_pairs = _pairs(np.bincount(second)).sum()
+    expected = first_pairs * second_pairs / float(_pairs(len(first)))
+    maximum = (first_pairs + second_pairs) / 2.0
+    if maximum == expected:
+        return 1.0
+    return (index - expected) / (maximum - expected)
+
+
+def _pairs(counts):
+    counts = np.asarray(counts, dtype=np.float64)
+    return counts * (counts - 1) / 2.0
+
+
+def bootstrap_consensus(
+    ranks,
+    nr_resamples,
+    threshold,
+    absolute=True,
+    consensus_level=0.5,
+    random_state=None,
+    n_jobs=None,
+    max_cluster_size=None,
+):
+    """
+    Consensus clustering over bootstrap resamples of the realizations. The
+    ranks (realizations as rows, one column per observation) are copied once
+    to shared memory, and each resample is re-ranked and clustered by single
+    linkage, cut at the cophenetic distance threshold, in a worker process.
+    Returns the fraction of resamples where each pair of observations was in
+    the same cluster, as a sparse upper triangular matrix, and the consensus
+    clusters: observations joined by pairs co-assigned in at least
+    consensus_level of the resamples. The co-assignments grow with the
+    square of the cluster sizes, so with max_cluster_size the clusters of
+    each resample are split along the dendrogram until they fit, see
+    split_clusters.
+    """
+    random_state = random_state or np.random.RandomState()
+    nr_realizations, nr_points = ranks.shape
+    samples = [
+        random_state.randint(0, nr_realizations, nr_realizations)
+        for _ in range(nr_resamples)
+    ]
+
+    shared = RawArray("d", nr_realizations * nr_points)
+    np.frombuffer(shared, dtype=np.float64).reshape(ranks.shape)[:] = ranks
+    tasks = [(sample, threshold, absolute, max_cluster_size) for sample in samples]
+
+    n_jobs = min(n_jobs or multiprocessing.cpu_count(), nr_resamples)
+    if n_jobs <= 1:
+        _init_worker(shared, ranks.shape)
+        labels = [_cluster_resample(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(
+            n_jobs, initializer=_init_worker, initargs=(shared, ranks.shape)
+        )
+        try:
+            labels = pool.map(_cluster_resample, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    largest = max(np.bincount(clusters).max() for clusters in labels)
+    if max_cluster_size is None and largest > LARGE_CLUSTER_SIZE:
+        print(
+            "Warning: a resample cluster has {} observations, the co-assignment "
+            "matrix stores every pair within a cluster. A maximum cluster size "
+            "bounds it.".format(largest)
+        )
+
+    frequency = co_assignment(labels, nr_points) / float(nr_resamples)
+    consensus = graph_clusters(frequency >= consensus_level)
+    print(
+        "Bootstrap consensus of {} resamples: {} clusters, {} co-assigned "
+        "pairs".format(nr_resamples, consensus.max(), frequency.nnz)
+    )
+    return frequency, consensus
+
+
+def co_assignment(labels, nr_points):
+    """
+    Number of clusterings in labels where each pair of observations is in
+    the same cluster, as a sparse upper triangular matrix. Only pairs that
+    were co-assigned at least once are stored.
+    """
+    counts = csr_matrix((nr_points, nr_points), dtype=np.float64)
+    points = np.arange(nr_points)
+    for clusters in labels:
+        _, clusters = np.unique(clusters, return_inverse=True)
+        membership = csr_matrix(
+            (np.ones(nr_points), (points, clusters.ravel())),
+            shape=(nr_points, clusters.max() + 1),
+        )
+        counts = counts + membership.dot(membership.T)
+    return triu(counts, k=1).tocsr()
+
+
+def _init_worker(shared, shape):
+    global _shared_ranks
+    _shared_ranks = np.frombuffer(shared, dtype=np.float64).reshape(shape)
+
+
+def _cluster_resample(task):
+    sample, threshold, absolute, max_cluster_size = task
+    # Ranking the resampled ranks gives the ranks of the resampled data
+    ranks = standardized_ranks(_shared_ranks[sample], n_jobs=1)
+    linkage_matrix = single_linkage(
+        ranks.shape[1], correlation_distance_rows(ranks, absolute)
+    )
+    clusters = fcluster(linkage_matrix, threshold, criterion="distance")
+    if max_cluster_size is not None:
+        clusters, _ = split_clusters(linkage_matrix, clusters, max_cluster_size)
+    return clusters
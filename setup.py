@@ -24,6 +24,7 @@ setup(
         "semeio",
         "semeio.hook_implementations",
         "semeio.jobs.correlated_observations_scaling",
+        "semeio.jobs.spearman_correlation_job",
     ],
     entry_points={
         "ert": [
@@ -50,6 +51,7 @@ setup(
         "pandas",
         "six",
         "scipy",
+        'threadpoolctl; python_version >= "3.5"',
     ],
     setup_requires=["pytest-runner", "setuptools_scm"],
     tests_require=["pytest", "mock"],
@@ -0,0 +1,129 @@
+from collections import namedtuple
+
+import pytest
+
+from semeio.jobs.correlated_observations_scaling import catalog
+
+implementation_type = namedtuple("implementation_type", ["name"])
+
+
+class FakeActiveList(object):
+    def __init__(self):
+        self.indexes = []
+
+    def addActiveIndex(self, index):
+        self.indexes.append(index)
+
+
+class FakeNode(object):
+    def __init__(self, data_index):
+        self.data_index = data_index
+
+    def __len__(self):
+        return len(self.data_index)
+
+    def getIndex(self, nr):
+        return self.data_index[nr]
+
+
+class FakeStepList(object):
+    def __init__(self, steps):
+        self.steps = steps
+
+    def asList(self):
+        return list(self.steps)
+
+
+class FakeObsVector(object):
+    def __init__(self, name, nodes):
+        self.name = name
+        self.nodes = nodes
+        self.data_lookups = 0
+
+    def getImplementationType(self):
+        return implementation_type(self.name)
+
+    def getStepList(self):
+        return FakeStepList(sorted(self.nodes))
+
+    def getNode(self, step):
+        return self.nodes[step]
+
+    def hasData(self, active_mask, storage):
+        self.data_lookups += 1
+        return self.name == "GEN_OBS"
+
+
+class FakeStorage(object):
+    def __init__(self, realizations):
+        self.realizations = realizations
+
+    def realizationList(self, state):
+        return self.realizations
+
+
+class FakeFacade(object):
+    def __init__(self, observations, storage):
+        self.observations = observations
+        self.storage = storage
+
+    def get_observations(self):
+        return self.observations
+
+    def get_observation_key(self, nr):
+        return sorted(self.observations)[nr]
+
+    def get_current_fs(self):
+        return self.storage
+
+    def get_ensemble_size(self):
+        return 5
+
+
+def get_facade(realizations=(0, 1, 2)):
+    observations = {
+        "FOPR": FakeObsVector("SUMMARY_OBS", {1: None, 2: None}),
+        "GEN": FakeObsVector("GEN_OBS", {1: FakeNode([4, 7, 9])}),
+        "WOPR": FakeObsVector("SUMMARY_OBS", {3: None}),
+    }
+    return FakeFacade(observations, FakeStorage(list(realizations)))
+
+
+def test_catalog_entries():
+    facade = get_facade()
+    obs_catalog = catalog.ObservationCatalog(facade)
+
+    assert obs_catalog.keys == ["FOPR", "GEN", "WOPR"]
+    assert obs_catalog.entry("FOPR") == ("SUMMARY_OBS", (1, 2), (1, 1), None)
+    assert obs_catalog.entry("GEN")[:3] == ("GEN_OBS", (1,), (3,))
+    assert obs_catalog.entry("GEN").index_map.tolist() == [4, 7, 9]
+    assert obs_catalog.obs_index("GEN", [7, 9]) == [1, 2]
+    assert obs_catalog.obs_index("FOPR", [1]) == [1]
+    with pytest.raises(KeyError):
+        obs_catalog.obs_index("GEN", [5])
+
+
+def test_catalog_active_lists(monkeypatch):
+    monkeypatch.setattr(catalog, "ActiveList", FakeActiveList)
+    obs_catalog = catalog.ObservationCatalog(get_facade())
+
+    first = obs_catalog.active_list("GEN", [2, 0])
+
+    assert first.indexes == [2, 0]
+    assert obs_catalog.active_list("GEN", (2, 0)) is first
+    assert obs_catalog.active_list("FOPR", None).indexes == []
+
+
+def test_catalog_data_lookups():
+    facade = get_facade()
+    observations = facade.get_observations()
+
+    obs_catalog = catalog.ObservationCatalog(facade)
+    assert obs_catalog.keys_with_data(["GEN", "FOPR", "MISSING"]) == ["GEN"]
+    assert obs_catalog.keys_with_data(["GEN"]) == ["GEN"]
+    assert observations["GEN"].data_lookups == 1
+    assert observations["WOPR"].data_lookups == 0
+
+    facade.storage.realizations = []
+    assert catalog.ObservationCatalog(facade).keys_with_data(["GEN"]) == []
+    assert observations["GEN"].data_lookups == 1
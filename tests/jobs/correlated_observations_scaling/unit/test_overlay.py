@@ -0,0 +1,99 @@
+import sys
+from collections import namedtuple
+
+from semeio.jobs.correlated_observations_scaling import catalog, job, overlay
+from tests.jobs.correlated_observations_scaling.unit.test_catalog import (
+    FakeActiveList,
+    FakeFacade,
+    FakeNode,
+    FakeObsVector,
+    FakeStorage,
+)
+
+if sys.version_info >= (3, 3):
+    from unittest.mock import Mock
+else:
+    from mock import Mock
+
+
+class ScaledNode(FakeNode):
+    def __init__(self, data_index=(None,)):
+        super(ScaledNode, self).__init__(list(data_index))
+        self.calls = []
+
+    def set_std_scaling(self, scale_factor):
+        self.calls.append((scale_factor, None))
+
+    def updateStdScaling(self, scale_factor, active_list):
+        self.calls.append((scale_factor, active_list.indexes))
+
+
+def get_observations():
+    return {
+        "FOPR": FakeObsVector("SUMMARY_OBS", {1: ScaledNode(), 2: ScaledNode()}),
+        "WOPR": FakeObsVector(
+            "SUMMARY_OBS", {1: ScaledNode(), 2: ScaledNode(), 3: ScaledNode()}
+        ),
+        "GEN": FakeObsVector("GEN_OBS", {1: ScaledNode([4, 7, 9, 12])}),
+    }
+
+
+def test_update_scaling_overlay(monkeypatch):
+    monkeypatch.setattr(catalog, "ActiveList", FakeActiveList)
+    event = namedtuple("named_dict", ["key", "index"])
+    observations = get_observations()
+    scaling_overlay = overlay.ScalingOverlay(observations)
+
+    job._update_scaling(
+        observations,
+        2.0,
+        [event("FOPR", None), event("WOPR", [0, 2, 5]), event("GEN", None)],
+        scaling_overlay,
+    )
+    job._update_scaling(
+        observations, 3.0, [event("WOPR", [2]), event("GEN", [7, 12])], scaling_overlay
+    )
+    assert all(
+        node.calls == []
+        for obs_vector in observations.values()
+        for node in obs_vector.nodes.values()
+    )
+    scaling_overlay.commit()
+
+    assert [node.calls for node in observations["FOPR"].nodes.values()] == [
+        [(2.0, None)],
+        [(2.0, None)],
+    ]
+    assert [observations["WOPR"].nodes[step].calls for step in (1, 2, 3)] == [
+        [(2.0, None)],
+        [],
+        [(3.0, None)],
+    ]
+    assert observations["GEN"].nodes[1].calls == [(2.0, [0, 2]), (3.0, [1, 3])]
+
+
+def test_update_scaling_all_active(monkeypatch):
+    monkeypatch.setattr(catalog, "ActiveList", FakeActiveList)
+    event = namedtuple("named_dict", ["key", "index"])
+    observations = get_observations()
+
+    job._update_scaling(observations, 2.0, [event("GEN", [4, 7, 9, 12])])
+
+    assert observations["GEN"].nodes[1].calls == [(2.0, [])]
+
+
+def test_update_scaling_catalog(monkeypatch):
+    monkeypatch.setattr(catalog, "ActiveList", FakeActiveList)
+    obs_index_array = Mock(wraps=catalog.obs_index_array)
+    monkeypatch.setattr(catalog, "obs_index_array", obs_index_array)
+    event = namedtuple("named_dict", ["key", "index"])
+    observations = get_observations()
+    obs_catalog = catalog.ObservationCatalog(FakeFacade(observations, FakeStorage([0])))
+    scaling_overlay = overlay.ScalingOverlay(observations, obs_catalog)
+
+    job._update_scaling(observations, 2.0, [event("GEN", [7, 12])], scaling_overlay)
+    job._update_scaling(observations, 3.0, [event("GEN", [7, 12])], scaling_overlay)
+    scaling_overlay.commit()
+
+    assert obs_index_array.call_count == 1
+    assert observations["GEN"].nodes[1].calls == [(3.0, [1, 3])]
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from semeio.jobs.correlated_observations_scaling import parallel
+
+
+@pytest.mark.parametrize("use_shared_memory", [True, False])
+def test_primary_components_processes(monkeypatch, use_shared_memory):
+    if not use_shared_memory:
+        monkeypatch.setattr(parallel, "shared_memory", None)
+    np.random.seed(123)
+    matrix = np.random.rand(20, 12)
+    matrix[:, 5] = matrix[:, 4]
+    groups = [[0, 1, 2], [3, 4, 5, 6], [7], np.arange(12)]
+    thresholds = [0.95, 0.9, 0.95, 0.99]
+
+    expected = parallel.primary_components(matrix, groups, thresholds)
+    result = parallel.primary_components(matrix, groups, thresholds, n_jobs=2)
+
+    assert result == expected
+    assert expected[1][1] == parallel.duplicates_report(
+        parallel.find_duplicates(matrix[:, [3, 4, 5, 6]])
+    )
+    assert expected[2][0] == 1
+
+
+def test_shared_memory_released_without_pool(monkeypatch):
+    if parallel.shared_memory is None:
+        pytest.skip("shared memory requires Python 3.8")
+    blocks = []
+
+    def _share(matrix):
+        block, name = share(matrix)
+        blocks.append(block)
+        return block, name
+
+    def _pool(*args, **kwargs):
+        raise OSError("no processes")
+
+    share = parallel._share
+    monkeypatch.setattr(parallel, "_share", _share)
+    monkeypatch.setattr(parallel.multiprocessing, "Pool", _pool)
+
+    with pytest.raises(OSError):
+        parallel.primary_components(np.ones((3, 4)), [[0, 1], [2, 3]], [0.9, 0.9], 2)
+
+    with pytest.raises(FileNotFoundError):
+        parallel.shared_memory.SharedMemory(name=blocks[0].name)
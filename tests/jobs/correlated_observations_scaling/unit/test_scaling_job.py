@@ -1,4 +1,5 @@
 import os
+import re
 import shutil
 from collections import namedtuple
 from copy import deepcopy
@@ -10,11 +11,15 @@ import pytest
 from res.enkf import EnKFMain, ResConfig
 
 from ert_data import measured
+from ert_shared.libres_facade import LibresFacade
 from semeio.jobs.correlated_observations_scaling import (
+    catalog,
+    deduplication,
     job,
     job_config,
     scaled_matrix,
     validator,
+    wildcards,
 )
 from tests.jobs.correlated_observations_scaling.conftest import TEST_DATA_DIR
 
@@ -57,12 +62,10 @@ def test_create_observation_vectors(setup_ert):
     ert = EnKFMain(res_config)
     obs = ert.getObservations()
 
-    new_events = job._create_active_lists(obs, config.snapshot.UPDATE_KEYS.keys)
+    job._update_scaling(obs, 2.0, config.snapshot.UPDATE_KEYS.keys)
 
-    keys = [event.key for event in new_events]
-
-    assert "WPR_DIFF_1" in keys
-    assert "SNAKE_OIL_WPR_DIFF" not in keys
+    assert _std_scaling(obs, "WPR_DIFF_1") == 2.0
+    assert _std_scaling(obs, "SNAKE_OIL_WPR_DIFF") == 1.0
 
 
 @pytest.mark.parametrize(
@@ -170,6 +173,124 @@ def test_get_scaling_factor():
     assert matrix.get_scaling_factor(event) == np.sqrt(10 / 4.0)
 
 
+def test_get_scaling_factor_duplicates(capsys):
+    new_event = namedtuple("named_dict", ["keys", "threshold"])
+    event = new_event(["one_random_key"], 0.95)
+    np.random.seed(123)
+    input_matrix = np.random.rand(10, 6)
+    input_matrix = input_matrix[:, [0, 1, 1, 2, 3, 3, 3, 4, 5, 5]]
+    nr_components = scaled_matrix.DataMatrix._get_nr_primary_components(
+        input_matrix, 0.95
+    )
+
+    matrix = scaled_matrix.DataMatrix(pd.DataFrame(data=input_matrix))
+
+    assert matrix.get_scaling_factor(event) == pytest.approx(
+        np.sqrt(10 / float(nr_components))
+    )
+    assert "Unique observations" not in capsys.readouterr().out
+    _, report = matrix.get_scaling_factor_report(event)
+    assert report == deduplication.duplicates_report(
+        deduplication.find_duplicates(input_matrix)
+    )
+
+
+class FakeMeasuredData(object):
+    loads = []
+
+    def __init__(self, facade, keys, index_lists):
+        FakeMeasuredData.loads.append(list(keys))
+        frames = {}
+        for key, index_list in zip(keys, index_lists):
+            frame = facade[key]
+            if index_list is not None:
+                frame = measured.MeasuredData._filter_on_column_index(frame, index_list)
+            frames[key] = frame
+        self.data = pd.concat(frames, axis=1, names=["key_index", "data_index"])
+
+    def remove_failed_realizations(self):
+        pass
+
+    def remove_inactive_observations(self):
+        pass
+
+    def filter_ensemble_mean_obs(self, alpha):
+        pass
+
+    def filter_ensemble_std(self, std_cutoff):
+        simulated = self.data.drop(["OBS", "STD"])
+        self.data = self.data.loc[:, (simulated.std() > std_cutoff).values]
+
+
+@pytest.mark.parametrize("n_jobs", [None, 2])
+def test_batch_scaling_factors(monkeypatch, n_jobs):
+    np.random.seed(123)
+    data = {}
+    for key in ("A", "B", "C"):
+        frame = pd.DataFrame(np.random.rand(10, 6))
+        frame.loc["OBS"] = np.ones(6)
+        frame.loc["STD"] = np.ones(6) * 0.5
+        data[key] = frame
+    data["B"][3] = 1.0  # Constant, removed by the std filter
+    monkeypatch.setattr(job, "MeasuredData", FakeMeasuredData)
+    FakeMeasuredData.loads = []
+
+    event = namedtuple("named_dict", ["key", "index"])
+    calculate_keys = namedtuple(
+        "named_dict", ["keys", "threshold", "std_cutoff", "alpha"]
+    )
+    config = namedtuple("named_dict", ["CALCULATE_KEYS"])
+    group_keys = [
+        [event("A", None), event("B", None)],
+        [event("B", (1, 3, 4))],
+        [event("A", (0, 2)), event("C", None)],
+    ]
+    configs = [config(calculate_keys(keys, 0.95, 1e-6, 3.0)) for keys in group_keys]
+
+    result = job._batch_scaling_factors(data, configs, n_jobs)
+
+    assert FakeMeasuredData.loads == [["A", "B", "C"]]
+    FakeMeasuredData.loads = []
+    for config, scale_factor in zip(configs, result):
+        measured_data = FakeMeasuredData(
+            data,
+            [event.key for event in config.CALCULATE_KEYS.keys],
+            [event.index and list(event.index) for event in config.CALCULATE_KEYS.keys],
+        )
+        measured_data.filter_ensemble_std(config.CALCULATE_KEYS.std_cutoff)
+        matrix = scaled_matrix.DataMatrix(measured_data.data)
+        matrix.std_normalization(inplace=True)
+        assert scale_factor == matrix.get_scaling_factor(config.CALCULATE_KEYS)
+
+
+@pytest.mark.parametrize(
+    "tolerance,expected_groups,expected_representatives",
+    [(None, [0, 1, 0, 2, 3], [0, 1, 3, 4]), (0.01, [0, 1, 0, 2, 2], [0, 1, 3])],
+)
+def test_find_duplicates(tolerance, expected_groups, expected_representatives):
+    matrix = np.array([[1.0, 2.0, 1.0, 0.5, 0.501], [3.0, 1.0, 3.0, -0.2, -0.201]])
+
+    duplicates = deduplication.find_duplicates(matrix, tolerance)
+
+    assert duplicates.groups.tolist() == expected_groups
+    assert duplicates.representatives.tolist() == expected_representatives
+    assert duplicates.counts.sum() == 5
+
+
+def test_weighted_unique_columns():
+    np.random.seed(123)
+    matrix = np.random.rand(8, 5)[:, [0, 1, 1, 2, 3, 4, 4, 4]]
+    duplicates = deduplication.find_duplicates(matrix)
+
+    result = deduplication.weighted_unique_columns(matrix, duplicates)
+
+    assert result.shape == (8, 5)
+    assert np.allclose(
+        np.linalg.svd(result, compute_uv=False),
+        np.linalg.svd(matrix, compute_uv=False)[:5],
+    )
+
+
 @pytest.mark.parametrize(
     "threshold,expected_result", [(0.0, 1), (0.83, 2), (0.90, 3), (0.95, 4), (0.99, 6)]
 )
@@ -265,6 +386,50 @@ def test_find_and_expand_wildcards():
     assert result_dict == expected_dict
 
 
+def test_find_and_expand_negative_and_regex_patterns():
+    observation_list = ["WOPR_OP1_108", "WOPR_OP1_9", "WOPR_OP2_36", "FOPR", "FGPR"]
+    user_config = {
+        "CALCULATE_KEYS": {
+            "keys": [
+                {"key": "WOPR_*", "index": [1, 2]},
+                {"key": "!WOPR_OP1_1*"},
+                {"key": r"re:F.PR"},
+            ]
+        },
+        "UPDATE_KEYS": {"keys": [{"key": "*"}, {"key": "!re:WOPR_OP\\d_\\d+"}]},
+    }
+
+    result_dict = job._find_and_expand_wildcards(observation_list, user_config)
+
+    assert result_dict["CALCULATE_KEYS"]["keys"] == [
+        {"key": "WOPR_OP1_9", "index": [1, 2]},
+        {"key": "WOPR_OP2_36", "index": [1, 2]},
+        {"key": "FOPR"},
+        {"key": "FGPR"},
+    ]
+    assert result_dict["UPDATE_KEYS"]["keys"] == [{"key": "FOPR"}, {"key": "FGPR"}]
+    assert user_config["CALCULATE_KEYS"]["keys"][0] == {
+        "key": "WOPR_*",
+        "index": [1, 2],
+    }
+
+
+@pytest.mark.parametrize(
+    "patterns",
+    [["A*", "AB*", "*C", "re:A.C", "ABC"], ["[AB]?C", "AB?", "re:(A|B)+"], []],
+)
+def test_key_matcher(patterns):
+    keys = ["ABC", "AC", "ABD", "BBC", "C", "AB", "ABAB"]
+
+    result = wildcards.KeyMatcher(patterns).matches(keys)
+
+    expected = [
+        [key for key in keys if re.match(wildcards._expression(pattern), key)]
+        for pattern in patterns
+    ]
+    assert result == expected
+
+
 @pytest.mark.skipif(TEST_DATA_DIR is None, reason="no libres test-data")
 @pytest.mark.usefixtures("setup_tmpdir")
 def test_add_observation_vectors():
@@ -285,12 +450,21 @@ def test_add_observation_vectors():
 
     obs = ert.getObservations()
 
-    new_events = job._create_active_lists(obs, config.snapshot.UPDATE_KEYS.keys)
+    job._update_scaling(obs, 2.0, config.snapshot.UPDATE_KEYS.keys)
+
+    assert _std_scaling(obs, "WOPR_OP1_108") == 2.0
+    assert _std_scaling(obs, "WOPR_OP1_144") == 1.0
 
-    keys = [event.key for event in new_events]
 
-    assert "WOPR_OP1_108" in keys
-    assert "WOPR_OP1_144" not in keys
+def _std_scaling(obs, key):
+    """
+    The std scaling of the first data point of the first node of key
+    """
+    obs_vector = obs[key]
+    node = obs_vector.getNode(obs_vector.getStepList().asList()[0])
+    if obs_vector.getImplementationType().name == "SUMMARY_OBS":
+        return node.getStdScaling()
+    return node.getStdScaling(0)
 
 
 @pytest.mark.skipif(TEST_DATA_DIR is None, reason="no libres test-data")
@@ -305,15 +479,9 @@ def test_validate_failed_realizations():
 
     res_config = ResConfig("mini_fail_config")
     ert = EnKFMain(res_config)
-    observations = ert.getObservations()
+    obs_catalog = catalog.ObservationCatalog(LibresFacade(ert))
 
-    result = job.keys_with_data(
-        observations,
-        ["GEN_PERLIN_1"],
-        ert.getEnsembleSize(),
-        ert.getEnkfFsManager().getCurrentFileSystem(),
-    )
-    assert result == ["GEN_PERLIN_1"]
+    assert obs_catalog.keys_with_data(["GEN_PERLIN_1"]) == ["GEN_PERLIN_1"]
 
 
 @pytest.mark.skipif(TEST_DATA_DIR is None, reason="no libres test-data")
@@ -328,12 +496,6 @@ def test_validate_no_realizations():
 
     res_config = ResConfig("poly.ert")
     ert = EnKFMain(res_config)
-    observations = ert.getObservations()
+    obs_catalog = catalog.ObservationCatalog(LibresFacade(ert))
 
-    result = job.keys_with_data(
-        observations,
-        ["POLY_OBS"],
-        ert.getEnsembleSize(),
-        ert.getEnkfFsManager().getCurrentFileSystem(),
-    )
-    assert result == []
+    assert obs_catalog.keys_with_data(["POLY_OBS"]) == []
@@ -24,21 +24,27 @@ def test_spearman_correlation(monkeypatch):
     facade = Mock()
     mock_data = Mock()
     mock_data.get_simulated_data.return_value = df
+    obs_and_std = pd.DataFrame(
+        data=[[8, 9, 10], [1, 1, 1]], index=["OBS", "STD"], columns=df.columns
+    )
+    mock_data.data = pd.concat([df, obs_and_std])
     measured_data = Mock(return_value=mock_data)
-    scal_job = Mock()
-    monkeypatch.setattr(spearman, "scaling_job", scal_job)
+    update_scaling = Mock()
+    monkeypatch.setattr(spearman, "_update_scaling", update_scaling)
+    monkeypatch.setattr(spearman, "ObservationCatalog", Mock())
+    monkeypatch.setattr(spearman, "ScalingOverlay", Mock())
     monkeypatch.setattr(spearman, "MeasuredData", measured_data)
     spearman._spearman_correlation(facade, ["A_KEY"], 0.1, False)
 
-    assert measured_data.called_once_with(facade, ["A_KEY"])
-    assert scal_job.called_once()
+    measured_data.assert_called_once_with(facade, ["A_KEY"])
+    assert update_scaling.called
 
 
 @pytest.mark.skipif(TEST_DATA_DIR is None, reason="no libres test-data")
 @pytest.mark.usefixtures("setup_tmpdir")
 def test_main_entry_point_gen_data(monkeypatch):
-    scal_job = Mock()
-    monkeypatch.setattr(spearman, "scaling_job", scal_job)
+    update_scaling = Mock()
+    monkeypatch.setattr(spearman, "_update_scaling", update_scaling)
 
     test_data_dir = os.path.join(TEST_DATA_DIR, "local", "snake_oil")
 
@@ -52,4 +58,4 @@ def test_main_entry_point_gen_data(monkeypatch):
 
     spearman.spearman_job(facade, 1.0, False)
 
-    assert scal_job.call_count == 71
+    assert update_scaling.call_count == 71
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.cluster.hierarchy import fcluster, linkage
+
+from semeio.jobs.spearman_correlation_job.cache import SpearmanCache
+
+
+def _data(seed=123):
+    np.random.seed(seed)
+    columns = pd.MultiIndex.from_tuples(
+        [("KEY", nr) for nr in range(4)], names=["key_index", "data_index"]
+    )
+    return pd.DataFrame(np.random.rand(5, 4), columns=columns)
+
+
+def test_fingerprint():
+    data = _data()
+    fingerprint = SpearmanCache.fingerprint(data)
+
+    assert SpearmanCache.fingerprint(data.copy()) == fingerprint
+    assert SpearmanCache.fingerprint(data.iloc[1:]) != fingerprint
+    assert SpearmanCache.fingerprint(data.iloc[:, 1:]) != fingerprint
+    assert SpearmanCache.fingerprint(_data(seed=1)) != fingerprint
+
+
+@pytest.mark.usefixtures("setup_tmpdir")
+def test_get_or_compute():
+    cache = SpearmanCache("cache")
+    calls = []
+
+    def _compute():
+        calls.append(1)
+        return np.arange(10.0)
+
+    first = cache.get_or_compute("fingerprint", "ranks", _compute)
+    second = cache.get_or_compute("fingerprint", "ranks", _compute)
+
+    assert len(calls) == 1
+    assert (first == second).all()
+
+    cache.invalidate()
+    cache.get_or_compute("fingerprint", "ranks", _compute)
+    assert len(calls) == 2
+
+
+@pytest.mark.usefixtures("setup_tmpdir")
+def test_evict_least_recently_used():
+    entry_size = len(np.arange(100.0).tobytes())
+    cache = SpearmanCache("cache", max_size=2.5 * entry_size)
+    for nr, fingerprint in enumerate(["first", "second"]):
+        cache.store(fingerprint, "ranks", np.arange(100.0))
+        os.utime(os.path.join("cache", fingerprint), (nr, nr))
+
+    cache.load("first", "ranks")
+    cache.store("third", "ranks", np.arange(100.0))
+
+    assert sorted(os.listdir("cache")) == ["first", "third"]
+
+
+@pytest.mark.usefixtures("setup_tmpdir")
+def test_cached_linkage_clusters():
+    np.random.seed(123)
+    linkage_matrix = linkage(np.random.rand(10, 3), "single")
+    cache = SpearmanCache("cache")
+    cache.store("fingerprint", "linkage_legacy", linkage_matrix)
+
+    cached = cache.get_or_compute("fingerprint", "linkage_legacy", None)
+
+    assert cached.flags.writeable
+    assert (
+        fcluster(cached, 1.15, criterion="inconsistent")
+        == fcluster(linkage_matrix, 1.15, criterion="inconsistent")
+    ).all()
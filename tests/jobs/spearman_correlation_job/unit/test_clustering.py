@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import pdist
+
+from semeio.jobs.spearman_correlation_job import clustering, correlation
+
+
+def _ranks(nr_realizations=30, nr_columns=40, seed=123):
+    np.random.seed(seed)
+    base = np.random.rand(nr_realizations, 4)
+    mixing = np.random.rand(4, nr_columns)
+    values = np.dot(base, mixing) + 0.1 * np.random.rand(nr_realizations, nr_columns)
+    return correlation.standardized_ranks(values)
+
+
+def test_single_linkage_equals_scipy():
+    np.random.seed(123)
+    distances = pdist(np.random.rand(25, 3))
+    expected = linkage(distances, "single")
+
+    result = clustering.single_linkage(
+        25, clustering.condensed_distance_rows(distances, 25)
+    )
+
+    assert np.allclose(result, expected)
+
+
+@pytest.mark.parametrize("absolute", [True, False])
+def test_correlation_single_linkage(absolute):
+    ranks = _ranks()
+    distances = correlation.condensed_correlation_distance(ranks, absolute=absolute)
+    expected = linkage(distances, "single")
+
+    result = clustering.single_linkage(
+        ranks.shape[1], clustering.correlation_distance_rows(ranks, absolute)
+    )
+
+    assert np.allclose(result[:, 2], expected[:, 2])
+    assert (
+        fcluster(result, 0.05, criterion="distance")
+        == fcluster(expected, 0.05, criterion="distance")
+    ).all()
+
+
+def test_single_linkage_too_few_points():
+    with pytest.raises(ValueError):
+        clustering.single_linkage(1, lambda index: np.zeros(1))
+
+
+@pytest.mark.parametrize("removed", [[], [0], [3, 7, 20]])
+def test_update_minimum_spanning_tree(removed):
+    ranks = _ranks(nr_columns=50)
+    # The first 40 observations were clustered before, 10 are new
+    edges = clustering.minimum_spanning_tree(
+        40, clustering.correlation_distance_rows(ranks[:, :40])
+    )
+    current = np.setdiff1d(np.arange(50), removed)
+    previous_points = np.where(current < 40, current, -1)
+    distance_row = clustering.correlation_distance_rows(ranks[:, current])
+
+    result, nr_rows = clustering.update_minimum_spanning_tree(
+        edges, previous_points, distance_row
+    )
+
+    expected = clustering.minimum_spanning_tree(len(current), distance_row)
+    assert len(result) == len(current) - 1
+    assert np.allclose(np.sort(result[:, 2]), np.sort(expected[:, 2]))
+    assert nr_rows < len(current)
+    result = clustering.linkage_from_tree(len(current), result)
+    expected = clustering.linkage_from_tree(len(current), expected)
+    assert (
+        fcluster(result, 0.05, criterion="distance")
+        == fcluster(expected, 0.05, criterion="distance")
+    ).all()
+
+
+@pytest.mark.parametrize("method", ["single", "average", "complete"])
+def test_nn_chain_merges_equals_scipy(method):
+    np.random.seed(123)
+    distances = pdist(np.random.rand(40, 3))
+    expected = linkage(distances, method)
+
+    merges = clustering.nn_chain_merges(distances.copy(), 40, method)
+
+    result = clustering.linkage_from_tree(40, merges)
+    assert np.allclose(result[:, 2], expected[:, 2])
+    assert np.allclose(result[:, 3], expected[:, 3])
+    assert (
+        fcluster(result, 0.3, criterion="distance")
+        == fcluster(expected, 0.3, criterion="distance")
+    ).all()
+
+
+def test_nn_chain_merges_sizes():
+    # Point 0 stands for three observations, point 1 for one
+    np.random.seed(123)
+    points = np.random.rand(6, 2)
+    expected = linkage(pdist(points[[0, 0, 0, 1, 2, 3, 4, 5]]), "average")
+
+    merges = clustering.nn_chain_merges(
+        pdist(points), 6, "average", sizes=[3, 1, 1, 1, 1, 1]
+    )
+
+    assert np.allclose(np.sort(merges[:, 2]), expected[2:, 2])
+
+
+def test_nn_chain_merges_unknown_method():
+    with pytest.raises(ValueError):
+        clustering.nn_chain_merges(np.zeros(1), 2, "ward")
+
+
+def test_split_clusters():
+    points = np.array([[0.0], [1.0], [2.0], [10.0], [11.0], [30.0]])
+    linkage_matrix = linkage(pdist(points), "single")
+    clusters = fcluster(linkage_matrix, 15.0, criterion="distance")
+
+    result, nr_splits = clustering.split_clusters(linkage_matrix, clusters, 3)
+
+    assert nr_splits == 1
+    assert result[0] == result[1] == result[2]
+    assert result[3] == result[4]
+    assert len(np.unique(result[[0, 3, 5]])) == 3
+
+
+@pytest.mark.parametrize("max_cluster_size", [1, 4, 10])
+def test_split_clusters_sizes(max_cluster_size):
+    np.random.seed(123)
+    linkage_matrix = linkage(pdist(np.random.rand(60, 2)), "single")
+    clusters = fcluster(linkage_matrix, 0.1, criterion="distance")
+
+    result, nr_splits = clustering.split_clusters(
+        linkage_matrix, clusters, max_cluster_size
+    )
+
+    assert np.bincount(result).max() <= max_cluster_size
+    assert len(np.unique(result)) == result.max()
+    # The new clusters only split the old ones
+    for cluster in np.unique(result):
+        assert len(np.unique(clusters[result == cluster])) == 1
+    assert nr_splits >= len(np.unique(result)) - len(np.unique(clusters)) > 0
+
+
+def test_graph_clusters():
+    graph = csr_matrix(([0.95, 0.91], ([0, 3], [2, 4])), shape=(5, 5), dtype=np.float64)
+    assert clustering.graph_clusters(graph).tolist() == [1, 2, 1, 3, 3]
+
+
+@pytest.mark.parametrize("criterion", ["inconsistent", "distance"])
+@pytest.mark.parametrize("max_clusters", [1, 3, 10])
+def test_search_threshold_max_clusters(criterion, max_clusters):
+    np.random.seed(123)
+    linkage_matrix = linkage(np.random.rand(30, 3), "single")
+
+    threshold = clustering.search_threshold(
+        linkage_matrix, criterion, max_clusters=max_clusters
+    )
+
+    candidates = clustering.threshold_candidates(linkage_matrix, criterion)
+    nr_clusters = [
+        fcluster(linkage_matrix, candidate, criterion=criterion).max()
+        for candidate in candidates
+    ]
+    expected = candidates[np.flatnonzero(np.array(nr_clusters) <= max_clusters)[0]]
+    assert threshold == expected
+
+
+@pytest.mark.parametrize("max_cluster_size", [1, 5, 30])
+def test_search_threshold_max_cluster_size(max_cluster_size):
+    np.random.seed(123)
+    linkage_matrix = linkage(np.random.rand(30, 3), "single")
+
+    threshold = clustering.search_threshold(
+        linkage_matrix, "distance", max_cluster_size=max_cluster_size
+    )
+
+    clusters = fcluster(linkage_matrix, threshold, criterion="distance")
+    assert np.bincount(clusters).max() <= max_cluster_size
+    candidates = clustering.threshold_candidates(linkage_matrix, "distance")
+    larger = candidates[candidates > threshold]
+    if len(larger) > 0:
+        clusters = fcluster(linkage_matrix, larger[0], criterion="distance")
+        assert np.bincount(clusters).max() > max_cluster_size
+
+
+def test_search_threshold_target_not_met(capsys):
+    points = np.array([[0.0], [0.0], [0.0], [1.0], [2.0]])
+    linkage_matrix = linkage(points, "single")
+
+    threshold = clustering.search_threshold(
+        linkage_matrix, "distance", max_cluster_size=2
+    )
+
+    assert threshold == 0.0
+    assert (
+        "no threshold gives no cluster larger than 2, using threshold 0.0"
+        in capsys.readouterr().out
+    )
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.distance import pdist, squareform
+from scipy.stats import rankdata
+
+from semeio.jobs.spearman_correlation_job import correlation
+
+
+def _simulated_data(nr_realizations=20, nr_columns=15, seed=123):
+    np.random.seed(seed)
+    values = np.random.rand(nr_realizations, nr_columns)
+    # Introduce ties
+    values[:, :5] = np.round(values[:, :5], 1)
+    columns = pd.MultiIndex.from_tuples(
+        [("KEY_{}".format(nr // 5), nr % 5) for nr in range(nr_columns)],
+        names=["key_index", "data_index"],
+    )
+    return pd.DataFrame(values, columns=columns)
+
+
+def test_rank_columns_equals_rankdata():
+    data = _simulated_data()
+    expected = np.column_stack(
+        [rankdata(data.values[:, nr]) for nr in range(data.shape[1])]
+    )
+    assert np.allclose(correlation._rank_columns(data.values), expected)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 4])
+def test_spearman_correlation_matrix(n_jobs, monkeypatch):
+    monkeypatch.setattr(correlation, "_RANK_CHUNK_SIZE", 4)
+    data = _simulated_data()
+    expected = data.rank().corr(method="pearson")
+
+    result = correlation.spearman_correlation_matrix(data, n_jobs=n_jobs)
+
+    assert (result.columns == expected.columns).all()
+    assert np.allclose(result.values, expected.values)
+
+
+def test_spearman_correlation_matrix_with_nan():
+    data = _simulated_data()
+    data.iloc[0, 0] = np.nan
+    expected = data.rank().corr(method="pearson")
+
+    result = correlation.spearman_correlation_matrix(data)
+
+    assert np.allclose(result.values, expected.values)
+
+
+@pytest.mark.parametrize("memory_budget", [None, 256])
+def test_condensed_correlation(memory_budget):
+    data = _simulated_data(nr_columns=23)
+    expected = squareform(data.rank().corr(method="pearson").values, checks=False)
+    ranks = correlation.standardized_ranks(data.values)
+
+    result = correlation.condensed_correlation(ranks, memory_budget=memory_budget)
+
+    assert np.allclose(result, expected)
+
+
+@pytest.mark.parametrize("memory_budget", [None, 256])
+def test_condensed_row_distance(memory_budget):
+    data = _simulated_data(nr_columns=23)
+    expected = pdist(data.rank().corr(method="pearson").values)
+    ranks = correlation.standardized_ranks(data.values)
+
+    result = correlation.condensed_row_distance(ranks, memory_budget=memory_budget)
+
+    assert np.allclose(result, expected)
+
+
+@pytest.mark.parametrize("memory_budget", [None, 256])
+def test_correlation_graph(memory_budget):
+    data = _simulated_data(nr_columns=23)
+    dense = data.rank().corr(method="pearson").values
+    expected = np.triu(np.abs(dense) >= 0.3, k=1)
+    ranks = correlation.standardized_ranks(data.values)
+
+    result = correlation.correlation_graph(ranks, 0.3, memory_budget=memory_budget)
+
+    assert (result.toarray() != 0).tolist() == expected.tolist()
+    assert np.allclose(result.toarray()[expected], dense[expected])
+
+
+def test_approximate_correlation_graph():
+    np.random.seed(123)
+    values = np.dot(np.random.rand(50, 5), np.random.rand(5, 300))
+    values += 0.05 * np.random.rand(50, 300)
+    # Strong negative correlation should also be found
+    values[:, 1] = -values[:, 0]
+    ranks = correlation.standardized_ranks(values)
+    exact = correlation.correlation_graph(ranks, 0.8)
+
+    result, estimated_recall = correlation.approximate_correlation_graph(
+        ranks, 0.8, recall=0.99, seed=123
+    )
+
+    found = result.toarray() != 0
+    assert estimated_recall >= 0.99
+    assert found[0, 1]
+    assert not (found & (exact.toarray() == 0)).any()
+    assert np.allclose(result.toarray()[found], exact.toarray()[found])
+    assert found.sum() >= 0.9 * exact.nnz
+
+
+def test_lsh_tables():
+    results = [correlation._lsh_tables(0.8, recall, 16) for recall in (0.5, 0.9, 0.99)]
+    for (nr_tables, estimated_recall), recall in zip(results, (0.5, 0.9, 0.99)):
+        assert estimated_recall >= recall
+    assert results[0][0] < results[1][0] < results[2][0]
+
+
+@pytest.mark.parametrize("absolute", [True, False])
+@pytest.mark.parametrize("memory_budget", [None, 256])
+def test_top_correlations(absolute, memory_budget):
+    data = _simulated_data(nr_columns=23)
+    dense = data.rank().corr(method="pearson").values
+    strength = np.abs(dense) if absolute else dense.copy()
+    np.fill_diagonal(strength, -np.inf)
+    ranks = correlation.standardized_ranks(data.values)
+
+    partners, correlations = correlation.top_correlations(
+        ranks, 4, absolute=absolute, memory_budget=memory_budget
+    )
+
+    assert partners.shape == correlations.shape == (23, 4)
+    expected = -np.sort(-strength, axis=1)[:, :4]
+    found = np.take_along_axis(strength, partners, axis=1)
+    assert np.allclose(found, expected)
+    assert np.allclose(correlations, np.take_along_axis(dense, partners, axis=1))
+    assert not (partners == np.arange(23)[:, np.newaxis]).any()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.cluster.hierarchy import fcluster
+
+from semeio.jobs.spearman_correlation_job.cache import SpearmanCache
+from semeio.jobs.spearman_correlation_job.clustering import (
+    correlation_distance_rows,
+    single_linkage,
+)
+from semeio.jobs.spearman_correlation_job.correlation import (
+    spearman_correlation_matrix,
+    standardized_ranks,
+)
+from semeio.jobs.spearman_correlation_job.incremental import (
+    IncrementalSpearman,
+    ObservationState,
+)
+
+if sys.version_info >= (3, 3):
+    from unittest.mock import Mock
+else:
+    from mock import Mock
+
+
+def _correlated_data(nr_realizations):
+    np.random.seed(123)
+    values = np.dot(np.random.rand(nr_realizations, 2), np.random.rand(2, 6))
+    values += 0.1 * np.random.rand(nr_realizations, 6)
+    # Tied and constant observations
+    values[:, 4] = np.round(values[:, 4])
+    values[:, 5] = 1.0
+    return pd.DataFrame(values)
+
+
+@pytest.mark.parametrize("reference_size", [5, 40])
+def test_incremental_spearman_exact(reference_size):
+    # With the whole ensemble as reference, the ranks are exact
+    data = _correlated_data(reference_size)
+    expected = spearman_correlation_matrix(data).values.copy()
+    expected[np.isnan(expected)] = 0.0
+    np.fill_diagonal(expected, 1.0)
+
+    tracker = IncrementalSpearman(reference_size)
+    assert [tracker.update(data.iloc[:end]) for end in (2, 3, reference_size)] == [
+        2,
+        1,
+        reference_size - 3,
+    ]
+
+    assert len(tracker) == reference_size
+    assert tracker.update(data) == 0
+    assert tracker.correlation(data.columns) == pytest.approx(expected)
+
+
+def test_incremental_spearman_approximate():
+    data = _correlated_data(200)
+    tracker = IncrementalSpearman(20)
+    for end in range(10, 210, 10):
+        tracker.update(data.iloc[:end])
+
+    expected = spearman_correlation_matrix(data.iloc[:, :4]).values
+    result = tracker.correlation(data.columns[:4])
+    assert np.abs(result - expected).max() < 0.1
+
+
+def test_incremental_spearman_matches():
+    data = _correlated_data(30)
+    data.iloc[3, 0] = np.nan
+    tracker = IncrementalSpearman()
+    tracker.update(data)
+
+    # The realization with missing data is not added
+    assert len(tracker) == 29
+    assert not tracker.matches(data)
+    complete = data.drop(index=3)
+    assert tracker.matches(complete)
+    assert tracker.matches(complete.iloc[:, :3])
+    assert not tracker.matches(complete.iloc[:20])
+
+    # New observations start the tracking over
+    tracker.update(complete.iloc[:10, :3])
+    assert len(tracker) == 10
+
+
+@pytest.mark.usefixtures("setup_tmpdir")
+def test_observation_state():
+    np.random.seed(123)
+    values = np.dot(np.random.rand(30, 3), np.random.rand(3, 25))
+    values += 0.05 * np.random.rand(30, 25)
+    data = pd.DataFrame(values)
+    cache = SpearmanCache("cache")
+    # Three observations removed and five added since the first run
+    ObservationState(cache, data.iloc[:, :20]).single_linkage(
+        standardized_ranks(data.values[:, :20]), "absolute"
+    )
+    data = data.drop(columns=[2, 9, 15])
+
+    state = ObservationState(cache, data)
+    ranks = state.standardized_ranks()
+    result = state.single_linkage(ranks, "absolute")
+
+    assert np.allclose(ranks, standardized_ranks(data.values))
+    expected = single_linkage(data.shape[1], correlation_distance_rows(ranks))
+    assert np.allclose(result[:, 2], expected[:, 2])
+    assert (
+        fcluster(result, 0.05, criterion="distance")
+        == fcluster(expected, 0.05, criterion="distance")
+    ).all()
+    assert (ObservationState(cache, data)._previous("hashes", "ranks")[0] >= 0).all()
+
+
+@pytest.mark.usefixtures("setup_tmpdir")
+def test_observation_state_stored_when_changed():
+    np.random.seed(123)
+    data = pd.DataFrame(np.random.rand(30, 10))
+    cache = SpearmanCache("cache")
+    state = ObservationState(cache, data)
+    state.single_linkage(state.standardized_ranks(), "absolute")
+    stored = sorted(os.listdir(os.path.join("cache", state.key)))
+
+    cache.store = Mock()
+    state = ObservationState(cache, data)
+    state.single_linkage(state.standardized_ranks(), "absolute")
+    assert cache.store.call_count == 0
+
+    state = ObservationState(cache, data.drop(columns=[3]))
+    state.single_linkage(state.standardized_ranks(), "absolute")
+    names = sorted(call[0][1] + ".npy" for call in cache.store.call_args_list)
+    assert names == stored
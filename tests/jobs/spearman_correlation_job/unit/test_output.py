@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from semeio.jobs.correlated_observations_scaling.job_config import _to_int_list
+from semeio.jobs.spearman_correlation_job import output
+
+
+@pytest.mark.parametrize(
+    "index,expected_result",
+    [
+        ([3], "3"),
+        ([0, 1, 2, 5, 7, 8], "0-2,5,7-8"),
+        (np.arange(500), "0-499"),
+        ([8, 2, 1, 2], "1-2,8"),
+    ],
+)
+def test_index_ranges(index, expected_result):
+    assert output.index_ranges(index) == expected_result
+
+
+@pytest.mark.usefixtures("setup_tmpdir")
+def test_write_clusters():
+    clustered_data = {
+        1: {"KEY_1": np.array([0, 1, 2, 4]), "WOPR:OP_1": np.array([7])},
+        2: {"KEY_2": np.arange(1000)},
+    }
+
+    output.write_clusters(clustered_data, "clusters.yml")
+
+    with open("clusters.yml") as fin:
+        result = yaml.safe_load(fin)
+
+    assert len(result) == 2
+    keys = result[0]["CALCULATE_KEYS"]["keys"]
+    assert [entry["key"] for entry in keys] == ["KEY_1", "WOPR:OP_1"]
+    assert _to_int_list(keys[0]["index"]) == [0, 1, 2, 4]
+    assert _to_int_list(keys[1]["index"]) == [7]
+    assert result[1]["CALCULATE_KEYS"]["keys"][0]["index"] == "0-999"
+
+
+@pytest.mark.usefixtures("setup_tmpdir")
+def test_write_top_partners():
+    columns = pd.MultiIndex.from_tuples(
+        [("KEY_1", 0), ("KEY_1", 1), ("KEY_2", 5)], names=["key_index", "data_index"]
+    )
+    partners = np.array([[1], [0], [0]])
+    correlations = np.array([[0.9], [0.9], [-0.5]])
+
+    output.write_top_partners("partners.npz", columns, partners, correlations)
+
+    with np.load("partners.npz") as result:
+        assert result["key"].tolist() == ["KEY_1", "KEY_1", "KEY_2"]
+        assert result["data_index"].tolist() == [0, 1, 5]
+        assert result["partners"].tolist() == partners.tolist()
+        assert result["correlation"].tolist() == correlations.tolist()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.cluster.hierarchy import fcluster
+
+from semeio.jobs.spearman_correlation_job import clustering, correlation, partition
+
+
+def _columns(keys):
+    return pd.MultiIndex.from_tuples(
+        [(key, nr) for nr, key in enumerate(keys)], names=["key_index", "data_index"]
+    )
+
+
+def _grouped_ranks(nr_groups=4, group_size=10, noise=0.01, seed=123):
+    np.random.seed(seed)
+    base = np.random.rand(40, nr_groups)
+    values = np.repeat(base, group_size, axis=1)
+    values += noise * np.random.rand(*values.shape)
+    return correlation.standardized_ranks(values)
+
+
+def test_partition_labels_key():
+    columns = _columns(["A", "A", "B", "C", "B"])
+    assert partition.partition_labels(columns).tolist() == [0, 0, 1, 2, 1]
+
+
+def test_partition_labels_pattern():
+    columns = _columns(["WOPR_1", "WWCT_1", "WOPR_2", "FOPR", "RFT"])
+    pattern_map = {"oil": ["WOPR*", "FOPR"], "water": ["WWCT*"]}
+
+    result = partition.partition_labels(columns, "pattern", pattern_map=pattern_map)
+
+    assert result.tolist() == [0, 1, 0, 0, 2]
+
+
+def test_partition_labels_sketch():
+    ranks = _grouped_ranks(noise=1.0e-8)
+    columns = _columns(["KEY"] * ranks.shape[1])
+
+    result = partition.partition_labels(columns, "sketch", ranks=ranks, seed=123)
+
+    # Nearly identical columns end up in the same partition
+    for group in range(4):
+        assert len(set(result[group * 10 : (group + 1) * 10])) == 1
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_partitioned_clusters(n_jobs):
+    ranks = _grouped_ranks()
+    # Each group is split over two partitions
+    partitions = np.tile(np.repeat([0, 1], 5), 4)
+    expected = fcluster(
+        clustering.single_linkage(
+            ranks.shape[1], clustering.correlation_distance_rows(ranks)
+        ),
+        0.2,
+        criterion="distance",
+    )
+
+    result = partition.partitioned_clusters(ranks, partitions, 0.2, n_jobs=n_jobs)
+
+    assert len(np.unique(result)) == len(np.unique(expected)) == 4
+    for group in range(4):
+        assert len(set(result[group * 10 : (group + 1) * 10])) == 1
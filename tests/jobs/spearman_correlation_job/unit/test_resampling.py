@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from semeio.jobs.spearman_correlation_job import resampling
+
+
+@pytest.mark.parametrize("stratified", [True, False])
+@pytest.mark.parametrize("size,expected_size", [(10, 10), (0.25, 25)])
+def test_subsample_realizations(stratified, size, expected_size):
+    random_state = np.random.RandomState(123)
+    realizations = np.arange(100)
+
+    result = resampling.subsample_realizations(
+        realizations, size, stratified, random_state
+    )
+
+    assert len(np.unique(result)) == expected_size
+    assert np.isin(result, realizations).all()
+    if stratified:
+        strata = np.array_split(realizations, expected_size)
+        assert all(sample in stratum for sample, stratum in zip(result, strata))
+
+
+def test_subsample_realizations_exclude():
+    random_state = np.random.RandomState(123)
+    first = resampling.subsample_realizations(range(20), 10, random_state=random_state)
+    second = resampling.subsample_realizations(
+        range(20), 10, random_state=random_state, exclude=first
+    )
+    assert sorted(np.r_[first, second].tolist()) == list(range(20))
+
+
+@pytest.mark.parametrize("size", [1, 21])
+def test_subsample_realizations_invalid_size(size):
+    with pytest.raises(ValueError):
+        resampling.subsample_realizations(range(20), size)
+
+
+@pytest.mark.parametrize(
+    "first,second,expected_result",
+    [
+        ([1, 1, 2, 2], [5, 5, 3, 3], 1.0),
+        ([1, 1, 1, 1], [1, 1, 1, 1], 1.0),
+        ([1, 1, 2, 2], [1, 2, 1, 2], -0.5),
+        ([1, 1, 1, 2, 2, 2], [1, 1, 2, 2, 3, 3], 0.24242424),
+    ],
+)
+def test_adjusted_rand_index(first, second, expected_result):
+    result = resampling.adjusted_rand_index(np.array(first), np.array(second))
+    assert result == pytest.approx(expected_result)
+
+
+def test_co_assignment():
+    labels = [np.array([1, 1, 2, 3]), np.array([1, 1, 1, 2])]
+
+    result = resampling.co_assignment(labels, 4).toarray()
+
+    expected = np.zeros((4, 4))
+    expected[0, 1] = 2
+    expected[0, 2] = expected[1, 2] = 1
+    assert result.tolist() == expected.tolist()
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_bootstrap_consensus(n_jobs):
+    random_state = np.random.RandomState(123)
+    factors = random_state.rand(40, 2)
+    values = np.column_stack(
+        [factors[:, 0]] * 3 + [factors[:, 1]] * 2 + [random_state.rand(40)]
+    )
+    values += 1e-3 * random_state.rand(*values.shape)
+    ranks = np.argsort(np.argsort(values, axis=0), axis=0) + 1.0
+
+    frequency, clusters = resampling.bootstrap_consensus(
+        ranks, 10, 0.1, random_state=random_state, n_jobs=n_jobs
+    )
+
+    frequency = frequency.toarray()
+    assert frequency.shape == (6, 6)
+    assert np.allclose(np.tril(frequency), 0.0)
+    assert np.allclose(frequency[0, 1:3], 1.0)
+    assert np.allclose(frequency[3, 4], 1.0)
+    assert np.allclose(frequency[:5, 5], 0.0)
+    assert clusters[0] == clusters[1] == clusters[2]
+    assert clusters[3] == clusters[4] != clusters[0]
+    assert len(np.unique(clusters)) == 3
+
+
+def test_bootstrap_consensus_max_cluster_size():
+    random_state = np.random.RandomState(123)
+    values = np.column_stack([random_state.rand(40)] * 6)
+    values += 1e-3 * random_state.rand(*values.shape)
+    ranks = np.argsort(np.argsort(values, axis=0), axis=0) + 1.0
+
+    frequency, _ = resampling.bootstrap_consensus(
+        ranks, 5, 0.5, random_state=random_state, n_jobs=1, max_cluster_size=2
+    )
+
+    # At most one partner per observation and resample
+    frequency = frequency.toarray()
+    assert ((frequency + frequency.T).sum(axis=1) <= 1.0 + 1e-12).all()
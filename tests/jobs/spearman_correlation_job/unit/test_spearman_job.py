@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 import sys
 
+import numpy as np
+import pandas as pd
 import pytest
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist, squareform
 from semeio.jobs.spearman_correlation_job import job as spearman
 
 if sys.version_info >= (3, 3):
@@ -9,39 +13,50 @@ if sys.version_info >= (3, 3):
 else:
     from mock import Mock
 
-@pytest.mark.parametrize(
-    "test_input",
-    [
-        ([{"CALCULATE_KEYS": {"keys": [{"key": "KEY_1", "index": [1]}]}}]),
-        ([{"CALCULATE_KEYS": {"keys": [{"key": "KEY_1", "index": [1, 2]}]}}]),
-        (
-            [
-                {
-                    "CALCULATE_KEYS": {
-                        "keys": [
-                            {"key": "KEY_1", "index": [1, 2]},
-                            {"key": "KEY_2", "index": [1, 2]},
-                        ]
-                    }
-                }
-            ]
-        ),
-        (
-            [
-                {"CALCULATE_KEYS": {"keys": [{"key": "KEY_1", "index": [1, 2]}]}},
-                {"CALCULATE_KEYS": {"keys": [{"key": "KEY_2", "index": [5, 6]}]}},
-            ]
-        ),
-    ],
-)
-def test_run_scaling(test_input, monkeypatch):
-    facade = Mock()
-    scal_job = Mock()
-    monkeypatch.setattr(spearman, "scaling_job", scal_job)
-    spearman._run_scaling(facade, test_input)
-    for input_config in test_input:
-        assert scal_job.any_call(input_config)
-    assert scal_job.call_count == len(test_input)
+def test_run_scaling(monkeypatch):
+    np.random.seed(123)
+    values = np.random.rand(5, 3)
+    values[:, 1] = 2 * values[:, 0]
+    columns = pd.MultiIndex.from_tuples(
+        [("KEY_1", 0), ("KEY_1", 1), ("KEY_2", 0)], names=["key_index", "data_index"]
+    )
+    data = pd.DataFrame(values, columns=columns)
+    data.loc["OBS"] = np.ones(3)
+    data.loc["STD"] = np.ones(3)
+    measured_data = Mock()
+    measured_data.data = data
+
+    update_scaling = Mock()
+    scaling_overlay = Mock()
+    monkeypatch.setattr(spearman, "_update_scaling", update_scaling)
+    monkeypatch.setattr(spearman, "ObservationCatalog", Mock())
+    monkeypatch.setattr(spearman, "ScalingOverlay", Mock(return_value=scaling_overlay))
+    job_configs = spearman._config_creation({1: {"KEY_1": [0, 1]}, 2: {"KEY_2": [0]}})
+
+    spearman._run_scaling(Mock(), measured_data, np.array([1, 1, 2]), job_configs)
+
+    assert update_scaling.call_count == 2
+    (_, first_factor, first_events, overlay), _ = update_scaling.call_args_list[0]
+    (_, second_factor, second_events, _), _ = update_scaling.call_args_list[1]
+    assert overlay is scaling_overlay
+    assert scaling_overlay.commit.call_count == 1
+    assert first_factor == pytest.approx(np.sqrt(2.0))
+    assert [(event.key, event.index) for event in first_events] == [("KEY_1", [0, 1])]
+    assert second_factor == 1.0
+    assert [(event.key, event.index) for event in second_events] == [("KEY_2", [0])]
+
+
+def test_cluster_scaling_factors_jobs():
+    np.random.seed(123)
+    data_matrix = np.random.rand(10, 9)
+    data_matrix[:, 1] = data_matrix[:, 0]
+    clusters = np.array([1, 1, 1, 2, 3, 3, 3, 3, 2])
+
+    expected = spearman._cluster_scaling_factors(data_matrix, clusters)
+    result = spearman._cluster_scaling_factors(data_matrix, clusters, jobs=2)
+
+    assert result == expected
+    assert sorted(result) == [1, 2, 3]
 
 
 @pytest.mark.parametrize(
@@ -50,10 +65,19 @@ def test_run_scaling(test_input, monkeypatch):
         ([(1, "KEY_1", 1)], {1:{"KEY_1": [1]}}),
         ([(1, "KEY_1", 1), (1, "KEY_1", 2)], {1: {"KEY_1": [1, 2]}}),
         ([(1, "KEY_1", 1), (2, "KEY_2", 2)], {1: {"KEY_1": [1]}, 2: {"KEY_2": [2]}}),
+        (
+            [(2, "KEY_2", 3), (1, "KEY_1", 2), (2, "KEY_1", 0), (1, "KEY_1", 1)],
+            {1: {"KEY_1": [1, 2]}, 2: {"KEY_1": [0], "KEY_2": [3]}},
+        ),
     ],
 )
 def test_make_clusters(test_input, expected_result):
-    result = spearman._cluster_data(test_input)
+    clusters, keys, data_index = zip(*test_input)
+    result = spearman._cluster_data(clusters, keys, data_index)
+    result = {
+        cluster: {key: index.tolist() for key, index in val.items()}
+        for cluster, val in result.items()
+    }
     assert result == expected_result
 
 
@@ -69,3 +93,179 @@ def test_make_clusters(test_input, expected_result):
 def test_config_creation(test_input, expected_result):
     result = spearman._config_creation(test_input)
     assert result == expected_result
+
+
+@pytest.mark.parametrize("distance", ["legacy", "absolute"])
+def test_deduplicated_linkage(distance):
+    np.random.seed(123)
+    values = np.dot(np.random.rand(20, 3), np.random.rand(3, 12))
+    values += 0.05 * np.random.rand(20, 12)
+    values = values[:, [0, 1, 2, 2, 3, 4, 5, 5, 5, 6, 7, 8, 9, 10, 11, 0]]
+    data = pd.DataFrame(values)
+    ranks = spearman.standardized_ranks(values)
+    duplicates = spearman.find_duplicates(ranks)
+    expected = spearman._calculate_linkage(data, ranks, distance)
+    threshold = 1.15 if distance == "legacy" else 0.1
+
+    result = spearman._calculate_linkage(data, ranks, distance, duplicates=duplicates)
+
+    assert len(duplicates.representatives) == 12
+    assert np.allclose(result[:, 2], expected[:, 2])
+    assert (
+        spearman._cluster_analysis(result, threshold, distance)
+        == spearman._cluster_analysis(expected, threshold, distance)
+    ).all()
+
+
+@pytest.mark.parametrize("distance", ["legacy", "absolute"])
+@pytest.mark.parametrize("deduplicate", [True, False])
+def test_calculate_linkage_average(distance, deduplicate):
+    np.random.seed(123)
+    values = np.random.rand(20, 12)[:, [0, 1, 2, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 0]]
+    data = pd.DataFrame(values)
+    ranks = spearman.standardized_ranks(values)
+    duplicates = spearman.find_duplicates(ranks) if deduplicate else None
+    if distance == "legacy":
+        distances = pdist(data.rank().corr(method="pearson").values)
+    else:
+        distances = 1.0 - np.abs(
+            squareform(data.rank().corr(method="pearson").values, checks=False)
+        )
+    expected = linkage(distances, "average")
+
+    result = spearman._calculate_linkage(
+        data, ranks, distance, duplicates=duplicates, method="average"
+    )
+
+    assert np.allclose(result[:, 2], expected[:, 2], atol=1e-6)
+
+
+
+@pytest.mark.parametrize(
+    "threshold,distance,required,expected",
+    [
+        (None, "legacy", True, spearman.LEGACY_THRESHOLD),
+        (0.3, "absolute", True, 0.3),
+        (None, "absolute", False, None),
+    ],
+)
+def test_clustering_threshold(threshold, distance, required, expected):
+    assert spearman._clustering_threshold(threshold, distance, required) == expected
+
+
+def test_threshold_required_before_loading(monkeypatch):
+    load_measured_data = Mock()
+    monkeypatch.setattr(spearman, "_load_measured_data", load_measured_data)
+
+    with pytest.raises(ValueError, match="threshold is required"):
+        spearman._spearman_correlation(
+            Mock(), ["A_KEY"], None, False, distance="absolute", bootstrap=10
+        )
+    assert not load_measured_data.called
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"sweep": [0.3, 0.5], "partition": "key"},
+        {"sweep": [0.3, 0.5], "clustering": "graph"},
+        {"auto_threshold_clusters": 10, "bootstrap": 10},
+        {"max_cluster_size": 5, "partition": "key"},
+        {"min_correlation": 0.8},
+        {"approximate_recall": 0.9, "partition": "key"},
+        {"partition": "pattern"},
+        {"linkage_method": "average", "partition": "key"},
+        {"linkage_method": "complete", "bootstrap": 10},
+        {"linkage_method": "average", "clustering": "graph"},
+        {"watch": 10, "bootstrap": 10},
+        {"watch": 10, "linkage_method": "complete"},
+        {"watch": 10, "deduplicate": True},
+    ],
+)
+def test_incompatible_options(monkeypatch, kwargs):
+    load_measured_data = Mock()
+    monkeypatch.setattr(spearman, "_load_measured_data", load_measured_data)
+
+    with pytest.raises(ValueError, match="require"):
+        spearman._spearman_correlation(
+            Mock(), ["A_KEY"], 0.5, False, distance="absolute", **kwargs
+        )
+    assert not load_measured_data.called
+
+
+def test_watch_realizations(monkeypatch):
+    np.random.seed(123)
+    data = pd.DataFrame(np.random.rand(20, 4))
+    facade = Mock()
+    facade.get_ensemble_size.return_value = 20
+    # Number of realizations with data at each poll
+    polls = iter([2, 3, 8, 9, 20])
+    finished = []
+    loads = []
+
+    def realization_list(state):
+        finished.append(next(polls))
+        return list(range(finished[-1]))
+
+    def active_measured_data(facade, obs_keys):
+        loads.append(finished[-1])
+        measured_data = Mock()
+        measured_data.get_simulated_data.return_value = data.iloc[: finished[-1]]
+        return measured_data
+
+    facade.get_current_fs.return_value.realizationList.side_effect = realization_list
+
+    sleep = Mock()
+    monkeypatch.setattr(spearman, "_active_measured_data", active_measured_data)
+    monkeypatch.setattr(spearman.time, "sleep", sleep)
+
+    tracker = spearman._watch_realizations(facade, ["A_KEY"], 10)
+
+    # Loaded when a tenth of the ensemble has finished since the last load
+    assert loads == [2, 8, 20]
+    assert sleep.call_count == 4
+    assert tracker.matches(data)
+
+
+def test_watch_realizations_memory_budget(monkeypatch):
+    facade = Mock()
+    facade.get_ensemble_size.return_value = 2
+    facade.get_current_fs.return_value.realizationList.return_value = [0, 1]
+    measured_data = Mock()
+    measured_data.get_simulated_data.return_value = pd.DataFrame(np.ones((2, 20)))
+    monkeypatch.setattr(
+        spearman, "_active_measured_data", Mock(return_value=measured_data)
+    )
+
+    tracker = spearman._watch_realizations(facade, ["A_KEY"], 10, memory_budget=100)
+    assert tracker is None
+
+
+@pytest.mark.parametrize("distance", ["legacy", "absolute"])
+def test_watched_clusters(monkeypatch, distance):
+    np.random.seed(123)
+    values = np.dot(np.random.rand(15, 2), np.random.rand(2, 8))
+    columns = pd.MultiIndex.from_tuples(
+        [("KEY_{}".format(nr), 0) for nr in range(8)],
+        names=["key_index", "data_index"],
+    )
+    data = pd.DataFrame(values + 0.01 * np.random.rand(15, 8), columns=columns)
+    measured_data = Mock()
+    measured_data.get_simulated_data.return_value = data
+    monkeypatch.setattr(
+        spearman, "_active_measured_data", Mock(return_value=measured_data)
+    )
+    cluster_data = Mock(return_value={})
+    monkeypatch.setattr(spearman, "_cluster_data", cluster_data)
+    facade = Mock()
+    facade.get_ensemble_size.return_value = 15
+    facade.get_current_fs.return_value.realizationList.return_value = range(15)
+
+    for watch in (None, 10):
+        spearman._spearman_correlation(
+            facade, ["A_KEY"], 0.5, True, distance=distance, watch=watch
+        )
+
+    (expected, _, _), _ = cluster_data.call_args_list[0]
+    (result, _, _), _ = cluster_data.call_args_list[1]
+    assert (result == expected).all()